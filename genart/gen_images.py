@@ -3,7 +3,10 @@ import skimage.io as skio
 import numpy as np
 import h5py
 import itertools
+import json
+import multiprocessing
 import random
+from pathlib import Path
 from typing import List
 from dataclasses import dataclass, field
 
@@ -27,6 +30,23 @@ class Shape:
 class RotatableShape(Shape):
     rotation: float = default_float()
 
+def shape_center(p, rr, cc, img_size):
+    """ pixel offsets from the centers of a record array of shapes, plus their half-sizes """
+    scale = 0.5 * min(img_size[0], img_size[1])
+    dr = rr - (p['y'] * img_size[0])[:,None,None]
+    dc = cc - (p['x'] * img_size[1])[:,None,None]
+    return dr, dc, (p['size'] * scale)[:,None,None]
+
+def local_coords(dr, dc, th):
+    """ rotate offsets into the shape's frame, inverting rotate_rc """
+    cos, sin = np.cos(th)[:,None,None], np.sin(th)[:,None,None]
+    return dr * cos + dc * sin, dc * cos - dr * sin
+
+def box_sdf(u, v, hu, hv):
+    qu, qv = np.abs(u) - hu, np.abs(v) - hv
+    outside = np.sqrt(np.maximum(qu, 0)**2 + np.maximum(qv, 0)**2)
+    return outside + np.minimum(np.maximum(qu, qv), 0)
+
 class Circle(Shape): 
     def render(self, img_size):
         radius = int(self.size * 0.5 * min(img_size[0], img_size[1]))
@@ -34,6 +54,11 @@ class Circle(Shape):
         c = int(self.x*img_size[1])        
         return skd.circle(r, c, radius, shape=img_size[:2])
 
+    @staticmethod
+    def batch_sdf(p, rr, cc, img_size):
+        dr, dc, radius = shape_center(p, rr, cc, img_size)
+        return np.sqrt(dr**2 + dc**2) - radius
+
 class CircleOutline(Shape): 
     def render(self, img_size):
         radius = int(self.size * 0.5 * min(img_size[0], img_size[1]))
@@ -41,6 +66,11 @@ class CircleOutline(Shape):
         c = int(self.x*img_size[1])        
         return skd.circle_perimeter(r, c, radius, shape=img_size[:2])
 
+    @staticmethod
+    def batch_sdf(p, rr, cc, img_size):
+        dr, dc, radius = shape_center(p, rr, cc, img_size)
+        return np.abs(np.sqrt(dr**2 + dc**2) - radius) - 0.5
+
 class Square(RotatableShape):
     def render(self, img_size):
         r = int(self.y*img_size[0])
@@ -59,6 +89,12 @@ class Square(RotatableShape):
 
         return rr, cc
 
+    @staticmethod
+    def batch_sdf(p, rr, cc, img_size):
+        dr, dc, hs = shape_center(p, rr, cc, img_size)
+        u, v = local_coords(dr, dc, p['rotation'] * np.pi)
+        return box_sdf(u, v, hs, hs)
+
 @dataclass
 class Rectangle(RotatableShape):
     aspect: float = default_float(low=0.0,high=1.0)
@@ -80,6 +116,12 @@ class Rectangle(RotatableShape):
 
         return rr, cc
 
+    @staticmethod
+    def batch_sdf(p, rr, cc, img_size):
+        dr, dc, hs = shape_center(p, rr, cc, img_size)
+        u, v = local_coords(dr, dc, p['rotation'] * np.pi)
+        return box_sdf(u, v, hs, hs * p['aspect'][:,None,None])
+
 @dataclass
 class Ellipse(RotatableShape):
     aspect: float = default_float(low=0.0,high=1.0)
@@ -95,6 +137,17 @@ class Ellipse(RotatableShape):
         rr,cc = rr.flatten(), cc.flatten()
         return rr,cc
 
+    @staticmethod
+    def batch_sdf(p, rr, cc, img_size):
+        dr, dc, ra = shape_center(p, rr, cc, img_size)
+        rb = np.maximum(ra * p['aspect'][:,None,None], 1e-6)
+        u, v = local_coords(dr, dc, p['rotation'] * 2 * np.pi - np.pi)
+
+        # first-order distance approximation from the implicit ellipse function
+        k0 = np.sqrt((u / ra)**2 + (v / rb)**2)
+        k1 = np.sqrt((u / ra**2)**2 + (v / rb**2)**2)
+        return np.where(k1 > 0, k0 * (k0 - 1.0) / np.maximum(k1, 1e-12), -np.minimum(ra, rb))
+
 class Triangle(RotatableShape):
     def render(self, img_size):
         r = int(self.y * img_size[0])
@@ -114,13 +167,41 @@ class Triangle(RotatableShape):
 
         return rr, cc
 
+    @staticmethod
+    def batch_sdf(p, rr, cc, img_size):
+        dr, dc, hw = shape_center(p, rr, cc, img_size)
+        u, v = local_coords(dr, dc, p['rotation'] * 2 * np.pi)
+        hh = hw * np.sqrt(3) * 0.5
+
+        # one vertical edge at v=-hh, apex at (0,hh)
+        return np.maximum(-hh - v,
+                          np.maximum(( np.sqrt(3) * u + v - hh) * 0.5,
+                                     (-np.sqrt(3) * u + v - hh) * 0.5))
+
 SHAPE_CHOICES = [ Circle, Triangle, Rectangle, Ellipse, Square ]
 
-def render_shapes(shapes, img_size, bg=None):
-    img = np.zeros(img_size, dtype=np.float32)
-    
+# type ids used in shape record arrays, -1 marks an empty slot
+SHAPE_TYPES = SHAPE_CHOICES + [ CircleOutline ]
+EMPTY_SHAPE = -1
+
+SHAPE_DTYPE = np.dtype([
+    ('type', np.int8),
+    ('color', np.float32, 3),
+    ('size', np.float32),
+    ('x', np.float32),
+    ('y', np.float32),
+    ('rotation', np.float32),
+    ('aspect', np.float32)
+])
+
+def render_shapes(shapes, img_size, bg=None, antialias=False):
     if bg is None:
         bg = np.random.random(3)
+
+    if antialias:
+        return render_shape_batch(shapes_to_array([shapes]), img_size, bg=[bg], antialias=True)[0]
+
+    img = np.zeros(img_size, dtype=np.float32)
     
     img[:,:,0] = bg[0]
     img[:,:,1] = bg[1]
@@ -134,6 +215,87 @@ def render_shapes(shapes, img_size, bg=None):
     
     return img
 
+def shapes_to_array(shape_sets):
+    """ pack per-image lists of Shapes (in draw order) into a (n_images, n_max) SHAPE_DTYPE array """
+    n_max = max([ len(shapes) for shapes in shape_sets ] + [1])
+
+    arr = np.zeros((len(shape_sets), n_max), dtype=SHAPE_DTYPE)
+    arr['type'] = EMPTY_SHAPE
+    arr['aspect'] = 1.0
+
+    for i, shapes in enumerate(shape_sets):
+        for j, shape in enumerate(shapes):
+            arr[i,j] = ( SHAPE_TYPES.index(type(shape)), shape.color, shape.size, shape.x, shape.y,
+                         getattr(shape, 'rotation', 0.0), getattr(shape, 'aspect', 1.0) )
+
+    return arr
+
+def batch_sdf(shapes, rr, cc, img_size, out=None):
+    """ signed distance (pixels, negative inside) of a 1D shape record array over the pixel grid """
+    if out is None:
+        out = np.empty((len(shapes), rr.shape[0], cc.shape[1]), dtype=np.float32)
+
+    out[shapes['type'] == EMPTY_SHAPE] = np.inf
+
+    for type_id, shape_type in enumerate(SHAPE_TYPES):
+        sel = np.nonzero(shapes['type'] == type_id)[0]
+        if len(sel):
+            out[sel] = shape_type.batch_sdf(shapes[sel], rr, cc, img_size)
+
+    return out
+
+def render_shape_batch(shapes, img_size, bg=None, dtype=np.float32, antialias=False):
+    """
+    rasterize a (n_images, n_max) SHAPE_DTYPE array into a (n_images, H, W, 3) batch.  Each shape slot
+    is evaluated for every image at once; painter's order is resolved by tracking the topmost slot
+    covering each pixel and gathering colors once at the end.
+
+    With antialias=True each shape is instead blended over the image by its pixel coverage,
+    approximated from the signed distance as clip(0.5 - sdf, 0, 1).  bg is one color for every
+    image or one per image.  Integer dtypes are scaled to 0-255, as in store_images.
+    """
+    n_images, n_max = shapes.shape
+
+    if bg is None:
+        bg = np.random.random((n_images, 3))
+    bg = np.broadcast_to(np.asarray(bg, dtype=np.float32).reshape(-1,3), (n_images, 3))
+
+    # sample at pixel centers so renders at different sizes line up under area downsampling
+    rr = np.arange(img_size[0], dtype=np.float32)[:,None] + 0.5
+    cc = np.arange(img_size[1], dtype=np.float32)[None,:] + 0.5
+
+    sdf = np.empty((n_images, img_size[0], img_size[1]), dtype=np.float32)
+
+    if antialias:
+        imgs = np.empty((n_images, img_size[0], img_size[1], 3), dtype=np.float32)
+        imgs[:] = bg[:,None,None,:]
+
+        for j in range(n_max):
+            batch_sdf(shapes[:,j], rr, cc, img_size, out=sdf)
+            coverage = np.clip(0.5 - sdf, 0.0, 1.0)[...,None]
+            imgs += coverage * (shapes['color'][:,j,None,None,:] - imgs)
+
+        if np.issubdtype(dtype, np.integer):
+            out = np.empty(imgs.shape, dtype=dtype)
+            store_images(out, imgs)
+            return out
+        return imgs.astype(dtype, copy=False)
+
+    top = np.zeros((n_images, img_size[0], img_size[1]), dtype=np.int16)
+
+    for j in range(n_max):
+        batch_sdf(shapes[:,j], rr, cc, img_size, out=sdf)
+        np.putmask(top, sdf <= 0, j+1)
+
+    # palette index 0 is the background
+    palette = np.concatenate([ bg[:,None,:], shapes['color'].astype(np.float32) ], axis=1)
+    if np.issubdtype(dtype, np.integer):
+        palette = np.clip(palette * 255 + 0.5, 0, 255)
+    palette = palette.astype(dtype)
+
+    imgs = np.take_along_axis(palette, top.reshape(n_images,-1,1), axis=1)
+    return imgs.reshape(n_images, img_size[0], img_size[1], 3)
+
 def random_shapes(shape, n_min, n_max):            
     n = np.random.randint(n_min, n_max+1)
 
@@ -143,6 +305,37 @@ def random_shapes(shape, n_min, n_max):
 
     return shapes
 
+def random_scenes(n, shape=None, n_min=1, n_max=20, rng=None):
+    """
+    sample n scenes in bulk as an (n, n_max) SHAPE_DTYPE array, drawn largest first like
+    random_shapes.  Unused slots are EMPTY_SHAPE and sort to the end.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    scenes = np.zeros((n, n_max), dtype=SHAPE_DTYPE)
+
+    if shape is None:
+        scenes['type'] = rng.integers(0, len(SHAPE_CHOICES), (n, n_max))
+    else:
+        scenes['type'] = SHAPE_TYPES.index(shape)
+
+    scenes['color'] = rng.uniform(0.0, 1.0, (n, n_max, 3))
+    scenes['size'] = rng.uniform(0.1, 0.9, (n, n_max))
+    scenes['x'] = rng.uniform(0.0, 1.0, (n, n_max))
+    scenes['y'] = rng.uniform(0.0, 1.0, (n, n_max))
+    scenes['rotation'] = rng.uniform(0.0, 1.0, (n, n_max))
+    scenes['aspect'] = rng.uniform(0.0, 1.0, (n, n_max))
+
+    counts = rng.integers(n_min, n_max+1, n)
+    scenes['type'][np.arange(n_max)[None,:] >= counts[:,None]] = EMPTY_SHAPE
+
+    # painter's order: largest first, empty slots last
+    key = np.where(scenes['type'] == EMPTY_SHAPE, -np.inf, scenes['size'])
+    order = np.argsort(-key, axis=1, kind='stable')
+
+    return np.take_along_axis(scenes, order, axis=1)
+
 def random_shape(shape=None):
     if shape is None:
         shape = random.choice(SHAPE_CHOICES)
@@ -177,32 +370,262 @@ def crop_rc(rr, cc, img_size):
     mask = (rr >= 0) & (rr < img_size[0]) & (cc >= 0) & (cc < img_size[1])     
     return rr[mask], cc[mask]
 
-def render_shape_sets(n, shape, img_sizes, n_min, n_max, dtype=np.float32):
-    img_sets = [ np.zeros([n]+list(img_size), dtype=dtype) for img_size in img_sizes ]
-
-    for i in range(n):
-        shapes = random_shapes(shape, n_min, n_max)
-
-        for j in range(len(img_sizes)):            
-            img_sets[j][i,:] = render_shapes(shapes, img_sizes[j])
-
-    return img_sets
-
-           
-
-
-if __name__ == "__main__":
-    shp = (512,512,3)
-    im = render_shape_sets(1, None, [shp,shp], 10, 10)
-    
-    import matplotlib.pyplot as plt
-    plt.imshow(im[1][0])
-    plt.axis('off')
-    plt.show()    
-    plt.savefig('test.png')
-
-        
-
-
+def area_downsample(imgs, factor):
+    """ box-filter a (n, H, W, C) batch by an integer factor """
+    if factor == 1:
+        return imgs
+
+    n, h, w, c = imgs.shape
+    return imgs.reshape(n, h // factor, factor, w // factor, factor, c).mean(axis=(2,4))
+
+def store_images(dst, imgs):
+    """ write [0,1] float images into dst, scaling to 0-255 for integer buffers """
+    if np.issubdtype(dst.dtype, np.integer):
+        imgs = np.clip(imgs * 255 + 0.5, 0, 255)
+
+    dst[...] = imgs
+
+def render_shape_sets(n, shape, img_sizes, n_min, n_max, dtype=np.float32,
+                      single_pass=False, supersample=1, batch_size=64, out=None, antialias=False,
+                      rng=None, return_scenes=False):
+    """
+    render n random shape images at each of img_sizes.  With single_pass=True each batch of
+    scenes is rasterized once at the largest size (times supersample) and every size is derived
+    from it by area downsampling, so sizes must divide the largest one evenly.  Results are
+    written into out (a list of preallocated arrays, one per size) when given.  antialias
+    blends shape edges by analytic coverage (see render_shape_batch).
+
+    Single-pass scenes and backgrounds are sampled in bulk from rng; pass return_scenes=True
+    to also get them back as ground truth, i.e. (out, scenes, bg).
+    """
+    if out is None:
+        out = [ np.zeros([n]+list(img_size), dtype=dtype) for img_size in img_sizes ]
+
+    if not single_pass:
+        if return_scenes:
+            raise ValueError("return_scenes requires single_pass=True")
+
+        for i in range(n):
+            shapes = random_shapes(shape, n_min, n_max)
+
+            for j in range(len(img_sizes)):
+                store_images(out[j][i], render_shapes(shapes, img_sizes[j], antialias=antialias))
+
+        return out
+
+    max_size = max(img_sizes, key=lambda s: s[0])
+    render_size = (max_size[0]*supersample, max_size[1]*supersample, 3)
+
+    factors = []
+    for img_size in img_sizes:
+        if (render_size[0] % img_size[0] or render_size[1] % img_size[1] or
+            render_size[0] // img_size[0] != render_size[1] // img_size[1]):
+            raise ValueError(f"size {img_size} does not evenly divide render size {render_size} "
+                             "by the same factor in both axes")
+        factors.append(render_size[0] // img_size[0])
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    scenes = random_scenes(n, shape, n_min, n_max, rng=rng)
+    bg = rng.uniform(0.0, 1.0, (n, 3))
+
+    for i in range(0, n, batch_size):
+        imgs = render_shape_batch(scenes[i:i+batch_size], render_size, bg=bg[i:i+batch_size],
+                                  antialias=antialias)
+
+        for j in range(len(img_sizes)):
+            store_images(out[j][i:i+batch_size], area_downsample(imgs, factors[j]))
+
+    if return_scenes:
+        return out, scenes, bg
+
+    return out
+
+def shape_batch_worker(queue, seed, stream, worker_id, batch_size, gi_params):
+    # every worker gets its own deterministic stream
+    seed_seq = np.random.SeedSequence([seed, stream, worker_id])
+    state = seed_seq.generate_state(2)
+    np.random.seed(state[0])
+    random.seed(int(state[1]))
+    rng = np.random.default_rng(seed_seq)
+
+    while True:
+        queue.put(render_shape_sets(batch_size, rng=rng, **gi_params))
+
+def iter_shape_batches(batch_size, n_workers=4, seed=0, prefetch=2, stream=0, **gi_params):
+    """
+    endless stream of render_shape_sets(batch_size, **gi_params) batches rendered on background
+    processes.  Batches are taken round-robin from the workers, so the stream is reproducible
+    for a given seed, stream and n_workers; use a different stream for each pass that should
+    see different images.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queues = [ ctx.Queue(maxsize=prefetch) for _ in range(n_workers) ]
+    workers = [ ctx.Process(target=shape_batch_worker,
+                            args=(queues[w], seed, stream, w, batch_size, gi_params),
+                            daemon=True)
+                for w in range(n_workers) ]
+
+    for w in workers:
+        w.start()
+
+    try:
+        for i in itertools.count():
+            yield queues[i % n_workers].get()
+    finally:
+        for w in workers:
+            w.terminate()
+
+
+def size_key(img_size):
+    return f'{img_size[0]}x{img_size[1]}'
+
+def build_shape_dataset(out_dir, n, img_sizes, shape=None, n_min=1, n_max=20, shard_size=10000,
+                        seed=0, dtype=np.uint8, supersample=1, antialias=True):
+    """
+    render n scenes at every size in img_sizes into .npy shards under out_dir, along with their
+    scenes and backgrounds, and describe them in index.json.  Read back with ShapeShards.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    shards = []
+
+    for si, start in enumerate(range(0, n, shard_size)):
+        shard_n = min(shard_size, n - start)
+        shard = { 'n': shard_n, 'images': {} }
+
+        out = []
+        for img_size in img_sizes:
+            fname = f'images_{size_key(img_size)}_{si:05d}.npy'
+            out.append(np.lib.format.open_memmap(out_dir / fname, mode='w+', dtype=dtype,
+                                                 shape=(shard_n,) + tuple(img_size)))
+            shard['images'][size_key(img_size)] = fname
+
+        _, scenes, bg = render_shape_sets(shard_n, shape, img_sizes, n_min, n_max,
+                                          single_pass=True, supersample=supersample,
+                                          out=out, antialias=antialias, rng=rng, return_scenes=True)
+
+        for img_set in out:
+            img_set.flush()
+
+        shard['scenes'] = f'scenes_{si:05d}.npy'
+        shard['bg'] = f'bg_{si:05d}.npy'
+        np.save(out_dir / shard['scenes'], scenes)
+        np.save(out_dir / shard['bg'], bg)
+
+        shards.append(shard)
+        print(f'wrote shard {si}, {start + shard_n}/{n} images')
+
+    index = {
+        'n': n,
+        'img_sizes': [ list(img_size) for img_size in img_sizes ],
+        'dtype': np.dtype(dtype).name,
+        'seed': seed,
+        'shards': shards
+    }
+
+    # written last, so a partial build has no index
+    with open(out_dir / 'index.json', 'w') as f:
+        json.dump(index, f, indent=2)
+
+class ShapeShards:
+    """
+    memory-mapped view of a dataset written by build_shape_dataset at one image size.  Indexing
+    within a shard returns np.memmap views without copying.
+    """
+    def __init__(self, path, img_size=None):
+        self.path = Path(path)
+
+        with open(self.path / 'index.json') as f:
+            self.index = json.load(f)
+
+        if img_size is None:
+            img_size = max(self.index['img_sizes'], key=lambda s: s[0])
+
+        self.img_size = tuple(img_size)
+        key = size_key(self.img_size)
+
+        shards = self.index['shards']
+        self.images = [ np.load(self.path / shard['images'][key], mmap_mode='r') for shard in shards ]
+        self.scenes = [ np.load(self.path / shard['scenes'], mmap_mode='r') for shard in shards ]
+        self.bg = [ np.load(self.path / shard['bg'], mmap_mode='r') for shard in shards ]
+
+        self.offsets = np.cumsum([0] + [ shard['n'] for shard in shards ])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.img_size
+
+    @property
+    def dtype(self):
+        return np.dtype(self.index['dtype'])
+
+    def take(self, arrays, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1 and start < stop:
+                si = np.searchsorted(self.offsets, start, side='right') - 1
+                if stop <= self.offsets[si+1]:
+                    return arrays[si][start-self.offsets[si]:stop-self.offsets[si]]
+            idx = np.arange(start, stop, step)
+
+        idx = np.asarray(idx)
+        if idx.ndim == 0:
+            # negative indices count from the end, as in numpy / h5py
+            i = idx + len(self) if idx < 0 else idx
+            if not 0 <= i < len(self):
+                raise IndexError(f"index {idx} out of range for {len(self)} images")
+            idx = i
+
+            si = np.searchsorted(self.offsets, idx, side='right') - 1
+            return arrays[si][idx - self.offsets[si]]
+
+        return np.stack([ self.take(arrays, int(i)) for i in idx ]) if len(idx) else arrays[0][:0]
+
+    def __getitem__(self, idx):
+        return self.take(self.images, idx)
+
+    def scenes_at(self, idx):
+        return self.take(self.scenes, idx)
+
+    def bg_at(self, idx):
+        return self.take(self.bg, idx)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='cmd')
+
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('out_dir')
+    build_parser.add_argument('--n', type=int, default=100000)
+    build_parser.add_argument('--sizes', type=int, nargs='+', default=[64,128,256])
+    build_parser.add_argument('--shard-size', type=int, default=10000)
+    build_parser.add_argument('--n-min', type=int, default=1)
+    build_parser.add_argument('--n-max', type=int, default=20)
+    build_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.cmd == 'build':
+        build_shape_dataset(args.out_dir, args.n, [ (s,s,3) for s in args.sizes ],
+                            n_min=args.n_min, n_max=args.n_max,
+                            shard_size=args.shard_size, seed=args.seed)
+    else:
+        shp = (512,512,3)
+        im = render_shape_sets(1, None, [shp,shp], 10, 10)
 
+        import matplotlib.pyplot as plt
+        plt.imshow(im[1][0])
+        plt.axis('off')
+        plt.show()
+        plt.savefig('test.png')
 
+if __name__ == "__main__": main()
@@ -3,25 +3,189 @@ import numpy as np
 from pathlib import Path
 import re
 import glob
+import json
+import time
+import collections
 
 def escape_path(p):
     return str(p).encode('unicode-escape').decode()
 
+class DecodedImageCache:
+    """
+    cache of decoded, squared uint8 images keyed by image index.  Entries are kept in a RAM LRU
+    bounded by max_bytes and, when memmap_file is given, in an on-disk (n, H, W, 3) uint8 memmap
+    with per-slot filled flags.  The memmap is opened in __init__, so create the cache before
+    starting DataLoader workers and every worker sees images decoded by the others.  Slots are
+    positions in idxs, so the idx list and shape are stored next to the memmap and the memmap is
+    rebuilt if either changes.
+    """
+    def __init__(self, idxs, image_shape=None, max_bytes=0, memmap_file=None):
+        self.slots = { idx: i for i, idx in enumerate(idxs) }
+        self.image_shape = tuple(image_shape) if image_shape else None
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.lru = collections.OrderedDict()
+
+        self.images = None
+        self.filled = None
+
+        if memmap_file:
+            if self.image_shape is None:
+                raise ValueError("an on-disk cache needs a fixed image_shape")
+
+            memmap_file = Path(memmap_file)
+            filled_file = memmap_file.with_suffix('.filled.npy')
+            meta_file = memmap_file.with_suffix('.meta.json')
+
+            meta = { 'idxs': [ int(idx) for idx in idxs ], 'image_shape': list(self.image_shape) }
+
+            mode = 'w+'
+            if memmap_file.exists() and filled_file.exists() and meta_file.exists():
+                with open(meta_file, 'r') as f:
+                    if json.load(f) == meta:
+                        mode = 'r+'
+
+            self.images = np.lib.format.open_memmap(memmap_file, mode=mode, dtype=np.uint8,
+                                                    shape=(len(idxs),) + self.image_shape)
+            self.filled = np.lib.format.open_memmap(filled_file, mode=mode, dtype=np.uint8,
+                                                    shape=(len(idxs),))
+
+            if mode == 'w+':
+                with open(meta_file, 'w') as f:
+                    json.dump(meta, f)
+
+    def get(self, idx):
+        if idx in self.lru:
+            self.lru.move_to_end(idx)
+            return self.lru[idx]
+
+        slot = self.slots.get(idx)
+        if self.filled is not None and slot is not None and self.filled[slot]:
+            image = np.array(self.images[slot])
+            self.put_ram(idx, image)
+            return image
+
+        return None
+
+    def put(self, idx, image):
+        slot = self.slots.get(idx)
+        if self.filled is not None and slot is not None and image.shape == self.image_shape:
+            self.images[slot] = image
+            self.images.flush()
+            self.filled[slot] = 1
+            self.filled.flush()
+
+        self.put_ram(idx, image)
+
+    def put_ram(self, idx, image):
+        if image.nbytes > self.max_bytes:
+            return
+
+        self.lru[idx] = image
+        self.n_bytes += image.nbytes
+
+        while self.n_bytes > self.max_bytes:
+            _, old = self.lru.popitem(last=False)
+            self.n_bytes -= old.nbytes
+
 class IndexedImageLoader:
-    def __init__(self, format, expected_shape=None):
+    def __init__(self, format, expected_shape=None, index_file=None, crop_decode=False,
+                 cache_bytes=0, cache_file=None, validate=False):
         self.format = Path(format)
         self.expected_shape = expected_shape
+        self.index_file = Path(index_file) if index_file else None
+        self.crop_decode = crop_decode
+
+        if self.index_file and self.index_file.exists():
+            self.index = self.read_index()
+            dirty = False
+        else:
+            self.index = { 'format': str(self.format), 'idxs': self.scan_index() }
+            dirty = True
 
+        # one-time header scan, kept in the index file
+        if validate and 'shapes' not in self.index:
+            self.index.update(self.scan_headers(self.index['idxs']))
+            dirty = True
+
+        quarantine = self.find_quarantine()
+        if self.index.get('quarantine') != quarantine:
+            self.index['quarantine'] = quarantine
+            dirty = True
+
+        quarantine = set(quarantine)
+        self.idxs = [ idx for idx in self.index['idxs'] if idx not in quarantine ]
+
+        if dirty and self.index_file:
+            self.write_index()
+
+        self.cache = None
+        if cache_bytes or cache_file:
+            image_shape = (expected_shape[0], expected_shape[1], 3) if expected_shape else None
+            # slots follow the full index, so quarantining a file doesn't shift the others
+            self.cache = DecodedImageCache(self.index['idxs'], image_shape, max_bytes=cache_bytes, memmap_file=cache_file)
+
+    def scan_index(self):
         fglob = str(self.format).format(index='*')
         
         self.image_files = [ Path(p) for p in glob.glob(fglob) ]
 
-        self.idxs = []
+        idxs = []
         for im in self.image_files:
             toks = re.split('[.\\\\-]+', str(im))
-            self.idxs.append(int(toks[-3]))
+            idxs.append(int(toks[-3]))
+
+        return sorted(idxs)
 
-        self.idxs = sorted(self.idxs)        
+    def scan_headers(self, idxs):
+        """ image shapes read from the JPEG headers, plus files whose header can't be read """
+        shapes = {}
+        corrupt = []
+
+        for idx in idxs:
+            try:
+                f = tf.io.read_file(self.image_path(idx))
+                shapes[str(idx)] = [ int(v) for v in tf.image.extract_jpeg_shape(f).numpy() ]
+            except (tf.errors.InvalidArgumentError, tf.errors.NotFoundError):
+                corrupt.append(idx)
+
+        return { 'shapes': shapes, 'corrupt': corrupt }
+
+    def find_quarantine(self):
+        """ indices to skip: corrupt files and, given expected_shape, files of the wrong shape """
+        if 'shapes' not in self.index:
+            return self.index.get('quarantine', [])
+
+        quarantine = set(self.index['corrupt'])
+        for idx, shape in self.index['shapes'].items():
+            if not self.shape_ok(shape):
+                quarantine.add(int(idx))
+
+        return sorted(quarantine)
+
+    def shape_ok(self, img_shape):
+        # expected_shape applies to the squared image
+        if not self.expected_shape:
+            return True
+
+        short_size = min(img_shape[0], img_shape[1])
+        return short_size == self.expected_shape[0] and short_size == self.expected_shape[1]
+
+    def read_index(self):
+        with open(self.index_file) as f:
+            index = json.load(f)
+
+        if index['format'] != str(self.format):
+            raise ValueError(f"index {self.index_file} was built for {index['format']}")
+
+        return index
+
+    def write_index(self):
+        with open(self.index_file, 'w') as f:
+            json.dump(self.index, f)
+
+    def image_path(self, idx):
+        return str(self.format).format(index="{0:05d}".format(idx))
 
     def __len__(self):
         return len(self.idxs)
@@ -31,22 +195,34 @@ class IndexedImageLoader:
         return image[:short_size, :short_size, :]
 
     def load_image(self, i=None, idx=None, square=True):
+        return self.to_float(self.load_image_uint8(i=i, idx=idx, square=square))
+
+    def to_float(self, image):
+        return (tf.cast(image, tf.float32) / 127.5) - 1.0
+
+    def load_image_uint8(self, i=None, idx=None, square=True):
         if idx is None:
             if i is None:
                 raise KeyError("not sure what I'm doing")
 
             idx = self.idxs[i]        
 
-        f = tf.io.read_file(str(self.format).format(index="{0:05d}".format(idx)))
-        
-        image = (tf.cast(tf.image.decode_jpeg(f), tf.float32) / 127.5) - 1.0
-        
-        if square:
-            image = self.square_image(image)
-        
-        if self.expected_shape:
-            if image.shape[0] != self.expected_shape[0] or image.shape[1] != self.expected_shape[1]:
-                raise ValueError("bad shape")
+        image = self.cache.get(idx) if (self.cache and square) else None
+
+        if image is None:
+            f = tf.io.read_file(self.image_path(idx))
+
+            image = tf.image.decode_jpeg(f)
+
+            if square:
+                image = self.square_image(image)
+
+            if self.expected_shape:
+                if image.shape[0] != self.expected_shape[0] or image.shape[1] != self.expected_shape[1]:
+                    raise ValueError("bad shape")
+
+            if self.cache and square:
+                self.cache.put(idx, image.numpy())
 
         return image
     
@@ -63,30 +239,97 @@ class IndexedImageLoader:
             return self.load_image(idx)[tf.newaxis,:,:,:]
 
     def load_patch(self, i, shape):
-        im = self.load_image(i=i, square=True)
+        # once the full image is cached, cropping it beats a partial decode
+        if self.crop_decode and not self.cache:
+            return self.load_patch_cropped(i, shape)
+
+        im = self.load_image_uint8(i=i, square=True)
 
         start = np.array([ np.random.randint(0, im.shape[0] - shape[0]), 
                            np.random.randint(0, im.shape[1] - shape[1]) ])
 
-        return im[start[0]:start[0]+shape[0],
-                  start[1]:start[1]+shape[1],:]
+        return self.to_float(im[start[0]:start[0]+shape[0],
+                                start[1]:start[1]+shape[1],:])
     
-    def iter_patch(self, shape, batch_size):
+    def load_patch_cropped(self, i, shape):
+        # read the size from the JPEG header and only decode the patch
+        f = tf.io.read_file(self.image_path(self.idxs[i]))
+        img_shape = tf.image.extract_jpeg_shape(f).numpy()
+
+        if not self.shape_ok(img_shape):
+            raise ValueError("bad shape")
+
+        short_size = min(img_shape[0], img_shape[1])
+        start = np.array([ np.random.randint(0, short_size - shape[0]),
+                           np.random.randint(0, short_size - shape[1]) ])
+
+        patch = tf.image.decode_and_crop_jpeg(f, [ start[0], start[1], shape[0], shape[1] ], channels=3)
+        return self.to_float(patch)
+
+    def load_patches(self, i, shape, k, max_overlap=None, max_tries=20):
+        """
+        k random patches from a single decode.  With max_overlap, each patch shares at most that
+        fraction of its area with earlier ones (falling back to the least overlapping of
+        max_tries candidates).
+        """
+        im = self.load_image_uint8(i=i, square=True)
+
+        starts = []
+        for _ in range(k):
+            best, best_overlap = None, None
+
+            for _ in range(max_tries if max_overlap is not None else 1):
+                start = np.array([ np.random.randint(0, im.shape[0] - shape[0]),
+                                   np.random.randint(0, im.shape[1] - shape[1]) ])
+
+                overlap = max([ patch_overlap(start, s, shape) for s in starts ] + [0.0])
+                if best is None or overlap < best_overlap:
+                    best, best_overlap = start, overlap
+
+                if max_overlap is None or overlap <= max_overlap:
+                    break
+
+            starts.append(best)
+
+        return [ self.to_float(im[s[0]:s[0]+shape[0], s[1]:s[1]+shape[1],:]) for s in starts ]
+
+    def iter_patch(self, shape, batch_size, patches_per_image=1, max_overlap=None):
+        """
+        batches of random patches.  With patches_per_image > 1 each decoded image yields that many
+        patches, and the patches from batch_size images are shuffled together before batching.
+        """
         for i in range(0, len(self.idxs), batch_size):
             start_i = i
             end_i = min(i + batch_size, len(self.idxs))
 
             imgs = []
             for ii in range(start_i, end_i):
-                img = self.load_patch(ii, shape)                                
-                imgs.append(img)
-                
-            yield tf.stack(imgs)
+                if patches_per_image == 1:
+                    imgs.append(self.load_patch(ii, shape))
+                else:
+                    imgs += self.load_patches(ii, shape, patches_per_image, max_overlap)
+
+            if patches_per_image == 1:
+                yield tf.stack(imgs)
+                continue
+
+            order = np.random.permutation(len(imgs))
+            for bi in range(0, len(imgs), batch_size):
+                yield tf.stack([ imgs[j] for j in order[bi:bi+batch_size] ])
+
+def patch_overlap(start1, start2, shape):
+    """ fraction of a patch's area shared by two patches of the same shape """
+    d = np.maximum(np.array(shape[:2]) - np.abs(start1 - start2), 0)
+    return d[0] * d[1] / (shape[0] * shape[1])
 
 class PairedImageLoader:
-    def __init__(self, set_1_format, set_2_format):
-        self.s1_loader = IndexedImageLoader(set_1_format)
-        self.s2_loader = IndexedImageLoader(set_2_format)
+    def __init__(self, set_1_format, set_2_format, expected_shapes=(None, None),
+                 cache_bytes=0, cache_files=(None, None)):
+        # the RAM budget is split between the two sets
+        self.s1_loader = IndexedImageLoader(set_1_format, expected_shape=expected_shapes[0],
+                                            cache_bytes=cache_bytes // 2, cache_file=cache_files[0])
+        self.s2_loader = IndexedImageLoader(set_2_format, expected_shape=expected_shapes[1],
+                                            cache_bytes=cache_bytes // 2, cache_file=cache_files[1])
 
         self.idxs = sorted(list(set(self.s1_loader.idxs) & set(self.s2_loader.idxs)))
 
@@ -105,8 +348,15 @@ class PairedImageLoader:
 
         return self.s1_loader.load_image(idx=idx, square=square), self.s2_loader.load_image(idx=idx, square=square)
 
-    def load_patch_pair(self, i, shp1):
-        im1, im2 = self.load_image_pair(i=i, square=True)
+    @property
+    def cached(self):
+        return self.s1_loader.cache is not None or self.s2_loader.cache is not None
+
+    def load_patch_pair_uint8(self, i, shp1):
+        """ aligned random uint8 crops, through the decoded-image caches when configured """
+        idx = self.idxs[i]
+        im1 = np.asarray(self.s1_loader.load_image_uint8(idx=idx, square=True))
+        im2 = np.asarray(self.s2_loader.load_image_uint8(idx=idx, square=True))
 
         sf = im2.shape[0] // im1.shape[0]
         shp2 = (shp1[0]*sf, shp1[1]*sf)
@@ -114,12 +364,12 @@ class PairedImageLoader:
         start1 = np.array([ np.random.randint(0, im1.shape[0] - shp1[0]), np.random.randint(0, im1.shape[1] - shp1[1]) ])
         start2 = start1 * sf
 
-        return (
-            im1[start1[0]:start1[0]+shp1[0],
-                start1[1]:start1[1]+shp1[1],:],
-            im2[start2[0]:start2[0]+shp2[0],
-                start2[1]:start2[1]+shp2[1],:]
-        )
+        return (im1[start1[0]:start1[0]+shp1[0], start1[1]:start1[1]+shp1[1],:],
+                im2[start2[0]:start2[0]+shp2[0], start2[1]:start2[1]+shp2[1],:])
+
+    def load_patch_pair(self, i, shp1):
+        im1, im2 = self.load_patch_pair_uint8(i, shp1)
+        return self.s1_loader.to_float(im1), self.s2_loader.to_float(im2)
     
     def iter_patch_pair(self, shape, batch_size):
         for i in range(0, len(self.idxs), batch_size):
@@ -131,15 +381,117 @@ class PairedImageLoader:
                 imgs.append(self.load_patch_pair(ii, shape))
             
             yield tf.stack([im[0] for im in imgs]), tf.stack([im[1] for im in imgs])
+
+    def to_dataset(self, shape, batch_size, shuffle=True, cycle_length=8):
+        """
+        tf.data version of iter_patch_pair: file pairs are read with a parallel interleave,
+        aligned random crops are taken in-graph (decoding only the cropped region), then
+        shuffled, batched and prefetched.
+
+        When a decoded-image cache is configured, crops come from the cache instead (see
+        cached_dataset): whole images are decoded once and reused on later epochs.
+        """
+        autotune = tf.data.experimental.AUTOTUNE
+
+        if self.cached:
+            return self.cached_dataset(shape, batch_size, shuffle=shuffle)
+
+        paths1 = [ self.s1_loader.image_path(idx) for idx in self.idxs ]
+        paths2 = [ self.s2_loader.image_path(idx) for idx in self.idxs ]
+
+        def read_pair(p1, p2):
+            return tf.data.Dataset.from_tensors((tf.io.read_file(p1), tf.io.read_file(p2)))
+
+        def crop_pair(f1, f2):
+            shp1 = tf.image.extract_jpeg_shape(f1)
+            shp2 = tf.image.extract_jpeg_shape(f2)
+
+            # square images, as with load_image(square=True)
+            short1 = tf.minimum(shp1[0], shp1[1])
+            sf = tf.minimum(shp2[0], shp2[1]) // short1
+
+            start1 = tf.stack([ tf.random.uniform([], 0, short1 - shape[0], dtype=tf.int32),
+                                tf.random.uniform([], 0, short1 - shape[1], dtype=tf.int32) ])
+            start2 = start1 * sf
+
+            im1 = tf.image.decode_and_crop_jpeg(f1, tf.concat([ start1, shape[:2] ], 0), channels=3)
+            im2 = tf.image.decode_and_crop_jpeg(f2, tf.concat([ start2, tf.constant(shape[:2]) * sf ], 0), channels=3)
+
+            im1 = (tf.cast(im1, tf.float32) / 127.5) - 1.0
+            im2 = (tf.cast(im2, tf.float32) / 127.5) - 1.0
+
+            im1.set_shape([ shape[0], shape[1], 3 ])
+            im2.set_shape([ None, None, 3 ])
+            return im1, im2
+
+        ds = tf.data.Dataset.from_tensor_slices((paths1, paths2))
+
+        if shuffle:
+            ds = ds.shuffle(len(paths1), reshuffle_each_iteration=True)
+
+        ds = ds.interleave(read_pair, cycle_length=cycle_length, num_parallel_calls=autotune)
+        ds = ds.map(crop_pair, num_parallel_calls=autotune)
+
+        if shuffle:
+            ds = ds.shuffle(batch_size * 8)
+
+        return ds.batch(batch_size).prefetch(autotune)
+
+    def cached_dataset(self, shape, batch_size, shuffle=True):
+        """
+        to_dataset over the decoded-image caches: uint8 crops from load_patch_pair_uint8 in a
+        generator (the caches are not thread safe, so this runs on one thread), converted to
+        float in-graph.
+        """
+        autotune = tf.data.experimental.AUTOTUNE
+        shp2 = [ None, None, 3 ]
+        if self.s1_loader.expected_shape and self.s2_loader.expected_shape:
+            sf = self.s2_loader.expected_shape[0] // self.s1_loader.expected_shape[0]
+            shp2 = [ shape[0]*sf, shape[1]*sf, 3 ]
+
+        def gen():
+            order = np.random.permutation(len(self.idxs)) if shuffle else range(len(self.idxs))
+            for i in order:
+                yield self.load_patch_pair_uint8(i, shape)
+
+        ds = tf.data.Dataset.from_generator(
+            gen, output_signature=(tf.TensorSpec([ shape[0], shape[1], 3 ], tf.uint8),
+                                   tf.TensorSpec(shp2, tf.uint8)))
+
+        ds = ds.map(lambda im1, im2: (self.s1_loader.to_float(im1), self.s2_loader.to_float(im2)),
+                    num_parallel_calls=autotune)
+
+        if shuffle:
+            ds = ds.shuffle(batch_size * 8)
+
+        return ds.batch(batch_size).prefetch(autotune)
+
+def benchmark_paired(loader, shape=(128,128), batch_size=10, n_batches=50):
+    """ images/sec of iter_patch_pair vs to_dataset """
+    results = {}
+
+    for name, batches in [ ('iter_patch_pair', loader.iter_patch_pair(shape, batch_size)),
+                           ('to_dataset', iter(loader.to_dataset(shape, batch_size))) ]:
+        next(batches) # warm up
+
+        n_images = 0
+        start = time.time()
+        for _ in range(n_batches):
+            try:
+                im1, _ = next(batches)
+            except StopIteration:
+                break
+            n_images += im1.shape[0]
+
+        results[name] = n_images / (time.time() - start)
+        print(f'{name}: {results[name]:.1f} images/sec')
+
+    return results
             
     
 if __name__ == '__main__':
     imdl = PairedImageLoader('images/small/img-small-{index}.jpg', 'images/large/img-large-{index}.jpg')
-    im1,im2 = imdl.load_image_pair_patch(0, (128,128))
+    im1,im2 = imdl.load_patch_pair(0, (128,128))
     print(im1.shape, im2.shape)
-    
-    #print(imdl.small_images)
-
-
-
 
+    benchmark_paired(imdl)
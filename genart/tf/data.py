@@ -1,6 +1,17 @@
 import h5py
+import numpy as np
+import tensorflow as tf
+import itertools
+
+def normalize_batch(x, dtype=tf.float32):
+    """ the first op of a model step: integer images to [0,1] floats, float images just cast """
+    x = tf.convert_to_tensor(x)
+    if x.dtype.is_integer:
+        return tf.cast(x, dtype) / x.dtype.max
+    return tf.cast(x, dtype)
 
 class GenartDataSet:
+    """ images from an HDF5 file, yielded in the file's dtype (see normalize_batch) """
     def __init__(self, h5_file):
         self.h5_file = h5_file
         self.hf = h5py.File(h5_file, 'r')
@@ -13,11 +24,112 @@ class GenartDataSet:
 
     def __call__(self):
         for i in range(len(self)):            
-            yield self[i], self[i]
+            x = self[i]
+            yield x, x
+
+    def read_block(self, start, size):
+        """ one contiguous slice, a single HDF5 read """
+        return self.hf["data"][start:start+size]
+
+    def iter_block_batches(self, start, block_size, batch_size, shuffle=True):
+        """ read one block and yield it as batches (views into the block) """
+        block = self.read_block(int(start), int(block_size))
+        batch_starts = np.arange(0, len(block), batch_size)
+        if shuffle:
+            batch_starts = np.random.permutation(batch_starts)
+
+        for bi in batch_starts:
+            yield block[bi:bi+batch_size]
+
+    def to_dataset(self, batch_size, batches_per_block=8, shuffle=True, cycle_length=4, drop_remainder=True):
+        """
+        tf.data.Dataset of (x, x) batches.  The file is read in contiguous blocks of
+        batches_per_block batches; blocks are visited in (shuffled) offset order and cycle_length
+        of them are read in parallel.  Each batch is read once and used as input and target.
+        """
+        block_size = batch_size * batches_per_block
+        offsets = tf.data.Dataset.from_tensor_slices(np.arange(0, len(self), block_size, dtype=np.int64))
+        if shuffle:
+            offsets = offsets.shuffle(len(offsets), reshuffle_each_iteration=True)
+
+        spec = tf.TensorSpec((None,) + tuple(self.shape[1:]), self.dtype)
+
+        ds = offsets.interleave(
+            lambda start: tf.data.Dataset.from_generator(
+                self.iter_block_batches,
+                args=(start, block_size, batch_size, shuffle),
+                output_signature=spec),
+            cycle_length=cycle_length,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=not shuffle)
+
+        if drop_remainder:
+            ds = ds.filter(lambda x: tf.shape(x)[0] == batch_size)
+            ds = ds.map(lambda x: tf.ensure_shape(x, (batch_size,) + tuple(self.shape[1:])))
+
+        return ds.map(lambda x: (x, x)).prefetch(tf.data.experimental.AUTOTUNE)
 
     @property
     def shape(self):
         return self.hf["data"].shape
 
+    @property
+    def dtype(self):
+        return tf.as_dtype(self.hf["data"].dtype)
+
     def __del__(self):
-        self.hf.close()
\ No newline at end of file
+        self.hf.close()
+
+class ShapeShardDataSet:
+    """ same interface as GenartDataSet, over a gen_images build directory """
+    def __init__(self, path, img_size=None):
+        from genart.gen_images import ShapeShards
+
+        self.shards = ShapeShards(path, img_size)
+
+    def __getitem__(self, idx):
+        return self.shards[idx]
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __call__(self):
+        for i in range(len(self)):
+            x = self[i]
+            yield x, x
+
+    @property
+    def shape(self):
+        return self.shards.shape
+
+    @property
+    def dtype(self):
+        return tf.as_dtype(self.shards.dtype)
+
+def shape_dataset(batch_size, img_shape, shape=None, n_min=1, n_max=20,
+                  n_workers=4, seed=0, prefetch=2, dtype=tf.float32, antialias=False):
+    """
+    infinite tf.data.Dataset of shape image batches rendered on background processes.  With
+    dtype=tf.uint8 batches are 0-255 and a quarter of the size; see normalize_batch.
+
+    Every iteration of the dataset starts a new worker pool on the next seed stream, so iterate
+    it once (e.g. it = iter(ds)) and pull batches from that rather than re-iterating per epoch.
+    """
+    import genart.gen_images as gi
+
+    gi_params = dict(shape=shape, img_sizes=(img_shape,), n_min=n_min, n_max=n_max,
+                     dtype=dtype.as_numpy_dtype, single_pass=True, antialias=antialias)
+
+    streams = itertools.count()
+
+    def gen():
+        for img_sets in gi.iter_shape_batches(batch_size, n_workers=n_workers, seed=seed,
+                                              prefetch=prefetch, stream=next(streams), **gi_params):
+            yield img_sets[0]
+
+    return tf.data.Dataset.from_generator(
+        gen,
+        output_types=dtype,
+        output_shapes=(batch_size,) + tuple(img_shape)
+    ).prefetch(tf.data.experimental.AUTOTUNE)
+
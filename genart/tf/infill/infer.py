@@ -0,0 +1,110 @@
+import tensorflow as tf
+import numpy as np
+import sys
+
+from genart.tf.infill.model import UNet
+
+def window_grid(h, w, window, core):
+    """
+    the image is split into core x core cells; each cell is filled from a window x window
+    context window centered on it (shifted to stay inside the image).
+    """
+    for cy in range(0, h, core):
+        for cx in range(0, w, core):
+            wy = min(max(cy - (window - core) // 2, 0), h - window)
+            wx = min(max(cx - (window - core) // 2, 0), w - window)
+            yield cy, cx, wy, wx
+
+class InpaintingService:
+    """
+    fills the masked pixels of arbitrary-size images with the infill UNet.  Construct once and
+    call inpaint repeatedly: context windows from every image in a call are batched together.
+    """
+    def __init__(self, generator, window=256, core=128, batch_size=16):
+        self.generator = generator
+        self.window = window
+        self.core = core
+        self.batch_size = batch_size
+
+        self.predict = tf.function(lambda x: generator(x, training=False))
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_dir, **kwargs):
+        generator = UNet()
+        checkpoint = tf.train.Checkpoint(generator=generator)
+        checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+        return cls(generator, **kwargs)
+
+    def model_input(self, image, mask):
+        # holes are zeroed and the mask is appended, as in training (see masks.masked_input)
+        mask = mask[...,None].astype(np.float32)
+        return np.concatenate([ image * (1.0 - mask), mask ], axis=-1)
+
+    def inpaint(self, images, masks):
+        """ images are (H, W, 3) in [-1, 1], masks (H, W) and True where pixels are missing """
+        results = []
+        jobs = []
+
+        for ri, (image, mask) in enumerate(zip(images, masks)):
+            h, w = mask.shape
+            pad = ((0, max(self.window - h, 0)), (0, max(self.window - w, 0)))
+
+            image = np.pad(np.asarray(image, dtype=np.float32), pad + ((0,0),), mode='edge')
+            mask = np.pad(np.asarray(mask, dtype=bool), pad)
+            results.append((image, mask, h, w))
+
+            for cy, cx, wy, wx in window_grid(mask.shape[0], mask.shape[1], self.window, self.core):
+                if mask[cy:cy+self.core, cx:cx+self.core].any():
+                    jobs.append((ri, cy, cx, wy, wx))
+
+        outputs = [ image.copy() for image, _, _, _ in results ]
+
+        for bi in range(0, len(jobs), self.batch_size):
+            batch_jobs = jobs[bi:bi+self.batch_size]
+
+            inputs = []
+            for ri, cy, cx, wy, wx in batch_jobs:
+                image, mask, _, _ = results[ri]
+                inputs.append(self.model_input(image[wy:wy+self.window, wx:wx+self.window],
+                                               mask[wy:wy+self.window, wx:wx+self.window]))
+
+            preds = self.predict(np.stack(inputs)).numpy()
+
+            for (ri, cy, cx, wy, wx), pred in zip(batch_jobs, preds):
+                _, mask, _, _ = results[ri]
+                core_mask = mask[cy:cy+self.core, cx:cx+self.core]
+                ch, cw = core_mask.shape
+
+                core_pred = pred[cy-wy:cy-wy+ch, cx-wx:cx-wx+cw]
+                core_out = outputs[ri][cy:cy+ch, cx:cx+cw]
+                core_out[core_mask] = core_pred[core_mask]
+
+        return [ out[:h, :w] for out, (_, _, h, w) in zip(outputs, results) ]
+
+def load_image(path):
+    image = tf.image.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    return (image.numpy().astype(np.float32) / 127.5) - 1.0
+
+def load_mask(path):
+    mask = tf.image.decode_image(tf.io.read_file(path), channels=1, expand_animations=False)
+    return mask.numpy()[:,:,0] > 127
+
+def save_image(path, image):
+    image = np.clip((image * 0.5 + 0.5) * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    tf.io.write_file(path, tf.image.encode_png(image))
+
+def main():
+    """ load the model once, then inpaint "image mask output" path triples read from stdin """
+    service = InpaintingService.from_checkpoint(sys.argv[1])
+
+    for line in sys.stdin:
+        toks = line.split()
+        if len(toks) != 3:
+            continue
+
+        image_path, mask_path, out_path = toks
+        out = service.inpaint([ load_image(image_path) ], [ load_mask(mask_path) ])[0]
+        save_image(out_path, out)
+        print(out_path, flush=True)
+
+if __name__ == "__main__": main()
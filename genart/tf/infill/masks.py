@@ -0,0 +1,76 @@
+import tensorflow as tf
+
+def pixel_grid(height, width):
+    yy, xx = tf.meshgrid(tf.range(height, dtype=tf.float32) + 0.5,
+                         tf.range(width, dtype=tf.float32) + 0.5, indexing='ij')
+    return yy, xx
+
+def random_active(batch_size, max_count, min_count=0):
+    """ [batch_size, max_count] flags with a random number of leading True values per row """
+    counts = tf.random.uniform([batch_size, 1], min_count, max_count + 1, dtype=tf.int32)
+    return tf.range(max_count)[tf.newaxis,:] < counts
+
+def random_rect_masks(batch_size, height, width, max_holes=3, min_size=0.1, max_size=0.5, min_holes=0):
+    """ [batch_size, height, width] bool, min_holes to max_holes axis-aligned rectangles per image """
+    yy, xx = pixel_grid(height, width)
+    shape = [batch_size, max_holes, 1, 1]
+    h = tf.random.uniform(shape, min_size, max_size) * tf.cast(height, tf.float32)
+    w = tf.random.uniform(shape, min_size, max_size) * tf.cast(width, tf.float32)
+    y0 = tf.random.uniform(shape) * (tf.cast(height, tf.float32) - h)
+    x0 = tf.random.uniform(shape) * (tf.cast(width, tf.float32) - w)
+
+    inside = (yy >= y0) & (yy < y0 + h) & (xx >= x0) & (xx < x0 + w)
+    inside &= random_active(batch_size, max_holes, min_holes)[:,:,tf.newaxis,tf.newaxis]
+
+    return tf.reduce_any(inside, axis=1)
+
+def random_stroke_masks(batch_size, height, width, max_strokes=3, max_vertices=8,
+                        max_step=0.25, min_width=0.02, max_width=0.08):
+    """ [batch_size, height, width] bool, 0 to max_strokes thick random-walk polylines per image """
+    yy, xx = pixel_grid(height, width)
+    size = tf.cast(tf.minimum(height, width), tf.float32)
+    scale = tf.cast(tf.stack([ height, width ]), tf.float32)
+
+    # random walk per stroke: [batch, stroke, vertex, 2] in pixels
+    start = tf.random.uniform([batch_size, max_strokes, 1, 2]) * scale
+    angle = tf.random.uniform([batch_size, max_strokes, max_vertices - 1], 0.0, 6.2832)
+    step = tf.random.uniform([batch_size, max_strokes, max_vertices - 1], 0.0, max_step) * size
+    delta = tf.stack([ tf.sin(angle) * step, tf.cos(angle) * step ], axis=-1)
+    vertices = tf.concat([ start, start + tf.cumsum(delta, axis=2) ], axis=2)
+    vertices = tf.clip_by_value(vertices, 0.0, scale)
+
+    # segments [batch, stroke, segment, 1, 1]
+    p0 = vertices[:,:,:-1]
+    p1 = vertices[:,:,1:]
+    d = p1 - p0
+    py, px = p0[...,0,tf.newaxis,tf.newaxis], p0[...,1,tf.newaxis,tf.newaxis]
+    dy, dx = d[...,0,tf.newaxis,tf.newaxis], d[...,1,tf.newaxis,tf.newaxis]
+
+    # distance from every pixel to every segment
+    t = ((yy - py) * dy + (xx - px) * dx) / tf.maximum(dy*dy + dx*dx, 1e-6)
+    t = tf.clip_by_value(t, 0.0, 1.0)
+    dist = tf.sqrt((yy - py - t*dy)**2 + (xx - px - t*dx)**2)
+
+    half_width = tf.random.uniform([batch_size, max_strokes, 1, 1, 1], min_width, max_width) * size * 0.5
+    inside = tf.reduce_any(dist < half_width, axis=2)
+    inside &= random_active(batch_size, max_strokes)[:,:,tf.newaxis,tf.newaxis]
+
+    return tf.reduce_any(inside, axis=1)
+
+def random_masks(batch_size, height, width, max_rects=3, max_strokes=3):
+    """
+    [batch_size, height, width, 1] float masks (1 = hole) mixing rectangles and free-form strokes.
+    Pure TF ops, so it can run inside tf.function or a tf.data map.
+    """
+    mask = random_rect_masks(batch_size, height, width, max_rects)
+    mask |= random_stroke_masks(batch_size, height, width, max_strokes)
+
+    # never hand the model an image without holes
+    empty = tf.logical_not(tf.reduce_any(mask, axis=[1,2]))[:,tf.newaxis,tf.newaxis]
+    mask |= empty & random_rect_masks(batch_size, height, width, max_holes=1, min_holes=1)
+
+    return tf.cast(mask, tf.float32)[...,tf.newaxis]
+
+def masked_input(images, masks):
+    """ generator input: the image with holes zeroed, plus the mask as a 4th channel """
+    return tf.concat([ images * (1.0 - masks), masks ], axis=-1)
@@ -39,8 +39,9 @@ def downsample(filters, size, apply_batchnorm=True):
 
     return result
 
-def UNet(levels=2):
-    inputs = Input(shape=[256,256,3]) # 256
+def UNet(levels=2, input_channels=4):
+    # image with holes zeroed plus the hole mask, see masks.masked_input
+    inputs = Input(shape=[256,256,input_channels]) # 256
     x = inputs
 
     down_stack = [
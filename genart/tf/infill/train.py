@@ -1,5 +1,6 @@
 import tensorflow as tf
 from genart.tf.infill.model import UNet, Discriminator
+from genart.tf.infill.masks import random_masks, masked_input
 from genart.gen_photos import IndexedImageLoader
 import time
 import matplotlib.pyplot as plt
@@ -27,12 +28,16 @@ def generator_loss(disc_generated_output, gen_output, target):
     return total_gen_loss
 
 @tf.function
-def train_step(input_image, target):
+def train_step(target):
+    # fresh holes every step, generated in-graph
+    masks = random_masks(tf.shape(target)[0], target.shape[1], target.shape[2])
+    input_image = masked_input(target, masks)
+
     with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
         gen_output = generator(input_image, training=True)
 
-        disc_real_output = discriminator([input_image, target], training=True)
-        disc_generated_output = discriminator([input_image, gen_output], training=True)
+        disc_real_output = discriminator([input_image[...,:3], target], training=True)
+        disc_generated_output = discriminator([input_image[...,:3], gen_output], training=True)
 
         gen_loss = generator_loss(disc_generated_output, gen_output, target)
         disc_loss = discriminator_loss(disc_real_output, disc_generated_output)
@@ -47,25 +52,17 @@ def train_step(input_image, target):
     discriminator_optimizer.apply_gradients(zip(discriminator_gradients,
                                                 discriminator.trainable_variables))
 
-def blanked_im(im):
-    im = im.numpy()
-    im[:,64:192,64:192,:] = 0.0
-    return tf.convert_to_tensor(im)
-
 def fit(train_ds, epochs, batch_size, test_ds):
     example_target = next(test_ds.iter_patch((256,256),3))
-    example_input = blanked_im(example_target)
+    example_input = masked_input(example_target, random_masks(3, 256, 256))
 
     for epoch in range(epochs):
         start = time.time()
 
         # Train        
         bi = 0
-        for im in test_ds.iter_patch((256,256), batch_size):
-            batch_target = im
-            batch_input = blanked_im(im)
-
-            train_step(batch_input, batch_target)
+        for im in test_ds.iter_patch((256,256), batch_size, patches_per_image=PATCHES_PER_IMAGE, max_overlap=0.25):
+            train_step(im)
             if bi % 100 == 0:
                 print(f'trained {bi*batch_size} images')
                 generate_images(generator, example_input, example_target, epoch, bi)
@@ -93,7 +90,7 @@ def generate_images(model, test_input, tar, epoch, image_num):
     title = ['Input Image', 'Ground Truth', 'Predicted Image']
     nrows = test_input.shape[0]
     for ri in range(nrows):
-        display_list = [test_input[ri], tar[ri], prediction[ri]]
+        display_list = [test_input[ri,:,:,:3], tar[ri], prediction[ri]]
         for ci in range(3):
             plt.subplot(nrows, 3, ri*3 + ci+1)
             if ri == 0:
@@ -107,8 +104,10 @@ def generate_images(model, test_input, tar, epoch, image_num):
 LAMBDA = 100
 EPOCHS = 100
 BATCH_SIZE = 10
+PATCHES_PER_IMAGE = 4
 
-data = IndexedImageLoader('images/large/img-large-{index}.jpg', expected_shape=(800,800))
+data = IndexedImageLoader('images/large/img-large-{index}.jpg', expected_shape=(800,800),
+                          index_file='images/large/index.json', crop_decode=True, validate=True)
 generator = UNet()
 discriminator = Discriminator()
 
@@ -1,7 +1,65 @@
 import h5py
+import numpy as np
+import tensorflow as tf
 
-def load_data(fname):    
+# column of the "end" command in the one-hot command type (see gen_morph.COMMAND_TYPES)
+END_COLUMN = 5
+
+def load_data(fname):
     with h5py.File(fname,'r') as f:
         data = f['data'][:]
 
-    return data
\ No newline at end of file
+    return data
+
+def data_shape(fname):
+    with h5py.File(fname,'r') as f:
+        return f['data'].shape
+
+def sequence_lengths(fname, chunk_size=1000):
+    """ true length of every sequence, including the first end command """
+    with h5py.File(fname,'r') as f:
+        ds = f['data']
+        n, max_len = ds.shape[:2]
+        lengths = np.zeros(n, dtype=np.int32)
+
+        for i in range(0, n, chunk_size):
+            is_end = ds[i:i+chunk_size,:,END_COLUMN] > 0.5
+            has_end = is_end.any(axis=1)
+            lengths[i:i+chunk_size] = np.where(has_end, is_end.argmax(axis=1) + 1, max_len)
+
+    return lengths
+
+def make_dataset(fname, idxs, lengths, batch_size,
+                 bucket_boundaries=(100, 200, 400, 700), shuffle=True):
+    """
+    stream sequences from the HDF5 file, truncated to their true length and bucket-batched
+    by length.  Batches are zero-padded to the longest sequence in the batch and yield
+    (x, x, weights), where weights are 0 over padding so the loss ignores it.
+    """
+    idxs = np.array(idxs)
+    n_features = data_shape(fname)[2]
+
+    def gen():
+        order = np.random.permutation(idxs) if shuffle else idxs
+
+        with h5py.File(fname,'r') as f:
+            ds = f['data']
+            for i in order:
+                x = ds[i,:lengths[i]].astype(np.float32)
+                yield x, x, np.ones(lengths[i], dtype=np.float32)
+
+    dataset = tf.data.Dataset.from_generator(
+        gen,
+        output_types=(tf.float32, tf.float32, tf.float32),
+        output_shapes=((None, n_features), (None, n_features), (None,))
+    )
+
+    bucket_batch_sizes = [ batch_size ] * (len(bucket_boundaries) + 1)
+
+    dataset = dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+        element_length_func=lambda x, y, w: tf.shape(x)[0],
+        bucket_boundaries=list(bucket_boundaries),
+        bucket_batch_sizes=bucket_batch_sizes
+    ))
+
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
@@ -1,16 +1,26 @@
 import tensorflow as tf
-from tensorflow.keras.layers import LSTM, GRU, Dense, Bidirectional, Input, RepeatVector, TimeDistributed, Dropout
-from tensorflow.keras.models import Sequential
+from tensorflow.keras.layers import GRU, Dense, Input, Dropout, Masking, Lambda
 from tensorflow.keras import Model
 
-def MorphModel(input_shape):
-    return Sequential([
-        GRU(512, activation='relu', input_shape=(input_shape[0], input_shape[1]), return_sequences=True),
-        GRU(256, activation='sigmoid', return_sequences=False),
-        Dropout(0.2),
-        RepeatVector(input_shape[0]),
-        GRU(256, activation='relu', return_sequences=True),
-        GRU(512, activation='relu', return_sequences=True),
-        TimeDistributed(Dense(input_shape[1]))
-    ])
-    
\ No newline at end of file
+def repeat_to_length(args):
+    latent, seq = args
+    return tf.repeat(latent[:,tf.newaxis,:], tf.shape(seq)[1], axis=1)
+
+def MorphModel(input_shape, mask_value=None):
+    # input_shape[0] may be None for variable-length (bucketed) batches
+    inputs = Input(shape=(input_shape[0], input_shape[1]))
+    x = inputs
+
+    if mask_value is not None:
+        x = Masking(mask_value=mask_value)(x)
+
+    x = GRU(512, activation='relu', return_sequences=True)(x)
+    x = GRU(256, activation='sigmoid', return_sequences=False)(x)
+    x = Dropout(0.2)(x)
+    x = Lambda(repeat_to_length)([x, inputs])
+    x = GRU(256, activation='relu', return_sequences=True)(x)
+    x = GRU(512, activation='relu', return_sequences=True)(x)
+    # Dense maps over the last axis; TimeDistributed breaks with an unknown time dimension
+    x = Dense(input_shape[1])(x)
+
+    return Model(inputs=inputs, outputs=x)
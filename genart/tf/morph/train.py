@@ -1,24 +1,49 @@
 import numpy as np
+import sys
+import time
 from genart.tf.morph.model import MorphModel
-from genart.tf.morph.data import load_data
+from genart.tf.morph.data import make_dataset, sequence_lengths, data_shape
 from tensorflow.keras.optimizers import Adam
 import sklearn.model_selection as sk
-from tensorflow.keras.callbacks import ModelCheckpoint
+from tensorflow.keras.callbacks import ModelCheckpoint, Callback
+
+class ThroughputCallback(Callback):
+    def __init__(self, n_sequences):
+        super().__init__()
+        self.n_sequences = n_sequences
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.time()
+        self.elapsed = None
+
+    def on_test_begin(self, logs=None):
+        # fit runs validation before on_epoch_end; only time the training batches
+        if self.elapsed is None:
+            self.elapsed = time.time() - self.start
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = self.elapsed if self.elapsed is not None else time.time() - self.start
+        print(f'epoch {epoch}: {self.n_sequences / elapsed:.1f} sequences/sec')
 
 np.random.seed(0)
 
 f = "E:/Workspace/genart/morphologies.h5"
 output_path = "E:/Workspace/genart/morph_weights.h5"
-d = load_data(f)
-#d = d[:,:1000,:]
-np.random.shuffle(d)
+batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+
+lengths = sequence_lengths(f)
+idxs = np.arange(len(lengths))
+
+idxs_train, idxs_test = sk.train_test_split(idxs, test_size=0.2, random_state = 42)
+train_ds = make_dataset(f, idxs_train, lengths, batch_size)
+test_ds = make_dataset(f, idxs_test, lengths, batch_size, shuffle=False)
 
-X_train, X_test, _, _ = sk.train_test_split(d,d, test_size=0.2, random_state = 42)
 checkpoint_callback = ModelCheckpoint(output_path)
+throughput_callback = ThroughputCallback(len(idxs_train))
 
-m = MorphModel(d.shape[1:])
+m = MorphModel((None, data_shape(f)[2]), mask_value=0.0)
 m.summary()
-m.compile(optimizer=Adam(lr=0.0001, clipnorm=1.0), loss='mse', metrics=['accuracy'])
-m.fit(X_train, X_train, batch_size=1, epochs=100, 
-      #validation_data=(X_test, X_test), 
-      callbacks=[checkpoint_callback])
\ No newline at end of file
+m.compile(optimizer=Adam(learning_rate=0.0001, clipnorm=1.0), loss='mse', metrics=['accuracy'])
+m.fit(train_ds, epochs=100,
+      validation_data=test_ds,
+      callbacks=[checkpoint_callback, throughput_callback])
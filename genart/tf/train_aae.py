@@ -9,6 +9,7 @@ import skimage.io as skio
 import imageio
 
 from genart.tf.model import GenartAutoencoder, GenartAaeDiscriminator
+from genart.tf.data import shape_dataset
 import genart.gen_images as gi
 
 mse = tf.keras.losses.mean_squared_error
@@ -90,15 +91,18 @@ def train(autoencoder, discriminator,
     img_seed = gi.render_shape_sets(seed_size, **gi_params)[0]
     latent_seed = tf.random.normal([seed_size, latent_size])
 
+    train_ds = shape_dataset(batch_size, gi_params['img_sizes'][0],
+                             shape=gi_params['shape'], n_min=gi_params['n_min'], n_max=gi_params['n_max'])
+
+    # one iterator for the whole run: the worker pool stays up and every epoch sees new images
+    train_it = iter(train_ds)
+
     for epoch in range(n_epochs):
         start = time.time()
 
-        print("generating images")
-        imgs = gi.render_shape_sets(epoch_size, **gi_params)[0]
-        print("training", imgs.shape)
-
-        for batch in range(0, epoch_size, batch_size):
-            batch_imgs = imgs[batch:batch+batch_size]
+        for bi in range(epoch_size // batch_size):
+            batch_imgs = next(train_it)
+            batch = bi * batch_size
             
             noise = tf.random.normal([batch_size, latent_size])
 
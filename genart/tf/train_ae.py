@@ -5,6 +5,7 @@ import time
 import os
 
 from genart.tf.model import GenartAutoencoder
+from genart.tf.data import shape_dataset
 import genart.gen_images as gi
 
 def aeloss(outputs, inputs):
@@ -41,15 +42,17 @@ def train_step(images):
     optimizer.apply_gradients(zip(gradients, autoencoder.trainable_variables))
 
 def train():
+    train_ds = shape_dataset(batch_size, img_shape, **gi_params)
+
+    # one iterator for the whole run: the worker pool stays up and every epoch sees new images
+    train_it = iter(train_ds)
+
     for epoch in range(n_epochs):
         start = time.time()
 
-        print("generating images")
-        imgs = gi.gen_shapes_set(epoch_size, **gi_params)
-        print("training", imgs.shape)
-
-        for batch in range(0, epoch_size, batch_size):
-            batch_imgs = imgs[batch:batch+batch_size]
+        for bi in range(epoch_size // batch_size):
+            batch_imgs = next(train_it)
+            batch = bi * batch_size
 
             train_step(batch_imgs)
 
@@ -79,26 +82,28 @@ batch_size = 10
 epoch_size = 1000
 n_epochs = 1000
 
-gi_params = { 'shape': None, 'img_shape': img_shape, 'n_min': 1, 'n_max': 20 }
+gi_params = { 'shape': None, 'n_min': 1, 'n_max': 20 }
+
+# shape_dataset renders on spawned worker processes, which re-import this script
+if __name__ == "__main__":
+    seed = gi.render_shape_sets(16, img_sizes=(img_shape,), single_pass=True, **gi_params)[0]
 
-seed = gi.gen_shapes_set(16, **gi_params)
+    #tf.keras.mixed_precision.experimental.set_policy('mixed_float16')
+    autoencoder = GenartAutoencoder(img_shape, latent_size)
+    optimizer = tf.keras.optimizers.Adam()
 
-#tf.keras.mixed_precision.experimental.set_policy('mixed_float16')
-autoencoder = GenartAutoencoder(img_shape, latent_size)
-optimizer = tf.keras.optimizers.Adam()
+    checkpoint_dir = 'out_ae/tf_ckpts'
+    ckpt = tf.train.Checkpoint(step=tf.Variable(1), optimizer=optimizer, net=autoencoder)
+    manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=3, keep_checkpoint_every_n_hours=1)
+    ckpt.restore(manager.latest_checkpoint)
 
-checkpoint_dir = 'out_ae/tf_ckpts'
-ckpt = tf.train.Checkpoint(step=tf.Variable(1), optimizer=optimizer, net=autoencoder)
-manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=3, keep_checkpoint_every_n_hours=1)
-ckpt.restore(manager.latest_checkpoint)
+    if manager.latest_checkpoint:
+        print("Restored from {}".format(manager.latest_checkpoint))
+    else:
+        print("Initializing from scratch.")
 
-if manager.latest_checkpoint:
-  print("Restored from {}".format(manager.latest_checkpoint))
-else:
-  print("Initializing from scratch.")
-  
 
-train()
+    train()
 #opt = tf.keras.mixed_precision.experimental.LossScaleOptimizer(opt, 'dynamic')
 #save_cb = SaveCB()
 
@@ -3,7 +3,7 @@ import tensorflow as tf
 import numpy as np
 import time
 from model import GenartAutoencoder, GenartAeGanDiscriminator, GenartAeGanGenerator
-from data import GenartDataSet
+from data import GenartDataSet, normalize_batch
 import matplotlib.pyplot as plt
 
 def discriminator_loss(real_output, fake_output):
@@ -17,6 +17,7 @@ def generator_loss(fake_output):
 
 @tf.function
 def train_step(images):
+    images = normalize_batch(images)
     noise = tf.random.normal([BATCH_SIZE, latent_size])
 
     with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape, tf.GradientTape() as ae_tape:
@@ -61,10 +62,10 @@ def train(dataset, epochs):
     for epoch in range(epochs):
         start = time.time()
 
-        for i in range(0, len(dataset), BATCH_SIZE):
+        for bi, (image_batch, _) in enumerate(dataset):
+            i = bi * BATCH_SIZE
             if i % 1000 == 0:
                 print(i)
-            image_batch = dataset[i:i+BATCH_SIZE]
             train_step(image_batch)
     
             if i % 2000 == 0:
@@ -95,13 +96,10 @@ latent_size = 256
 img_shape = ds.shape[1:3]
 
 ridx = np.sort(np.random.choice(np.arange(len(ds)), 16))
-seed = ds[ridx]
+seed = normalize_batch(ds[ridx])
 
-train_ds = tf.data.Dataset.from_generator(
-    ds, 
-    output_types=(tf.float32, tf.float32),
-    output_shapes=(ds.shape[1:], ds.shape[1:])
-).batch(BATCH_SIZE)
+# whole batches read as contiguous blocks; drop_remainder keeps the BATCH_SIZE noise shape valid
+train_ds = ds.to_dataset(BATCH_SIZE)
 
 cross_entropy = tf.keras.losses.BinaryCrossentropy(from_logits=True)
 
@@ -125,6 +123,6 @@ checkpoint = tf.train.Checkpoint(
 
 checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir))
 
-train(ds, EPOCHS)
+train(train_ds, EPOCHS)
 
 
@@ -5,7 +5,7 @@ import time
 import numpy as np
 
 from model import GenartAutoencoder, GenartGenerator, GenartDiscriminator
-from data import GenartDataSet
+from data import GenartDataSet, normalize_batch
 
 
 def discriminator_loss(real_output, fake_output):
@@ -36,7 +36,8 @@ def load_autoencoder(img_shape, latent_size):
 
 @tf.function
 def train_step(images):
-    noise = tf.random.normal([BATCH_SIZE, latent_size])
+    images = normalize_batch(images)
+    noise = tf.random.normal([tf.shape(images)[0], latent_size])
 
     with tf.GradientTape() as gen_tape, tf.GradientTape() as disc_tape:
         generated_images = generator(noise, training=True)
@@ -53,15 +54,36 @@ def train_step(images):
     generator_optimizer.apply_gradients(zip(gradients_of_generator, generator.trainable_variables))
     discriminator_optimizer.apply_gradients(zip(gradients_of_discriminator, discriminator.trainable_variables))
 
-def train(dataset, epochs):
+    return gen_loss, disc_loss
+
+@tf.function
+def train_steps(iterator, n_steps):
+    """ run n_steps train steps in one call, pulling batches from iterator inside the graph """
+    def body(i, gen_loss, disc_loss):
+        gen_loss, disc_loss = train_step(next(iterator))
+        return i + 1, gen_loss, disc_loss
+
+    _, gen_loss, disc_loss = tf.while_loop(lambda i, gen_loss, disc_loss: i < n_steps,
+                                           body,
+                                           [ tf.constant(0), tf.constant(0.0), tf.constant(0.0) ])
+    return gen_loss, disc_loss
+
+def train(dataset, epochs, steps_per_epoch):
+    iterator = iter(dataset)
+
+    # one plain step first, so model weights and optimizer slots are created outside the loop
+    train_step(next(iterator))
+
     for epoch in range(epochs):
         start = time.time()
 
-        for i in range(0, len(dataset), BATCH_SIZE):
-            if i % 1000 == 0:
-                print(i)
-            image_batch = dataset[i:i+BATCH_SIZE]
-            train_step(image_batch)
+        for step in range(0, steps_per_epoch, STEPS_PER_CALL):
+            n_steps = min(STEPS_PER_CALL, steps_per_epoch - step)
+            gen_loss, disc_loss = train_steps(iterator, tf.constant(n_steps))
+
+        elapsed = time.time() - start
+        print(f'epoch {epoch + 1}: {steps_per_epoch / elapsed:.1f} steps/sec, '
+              f'gen loss {float(gen_loss):.4f}, disc loss {float(disc_loss):.4f}')
     
         generate_and_save_images(generator,
                                 epoch + 1,
@@ -97,6 +119,7 @@ def generate_and_save_images(model, epoch, test_input):
 
 EPOCHS = 50
 BATCH_SIZE = 10
+STEPS_PER_CALL = 50
 
 img_shape = (256,256,3)
 latent_size = 2048
@@ -124,4 +147,7 @@ checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir))
 
 seed = tf.random.normal([num_examples_to_generate, latent_size])
 
-train(ds, EPOCHS)
\ No newline at end of file
+# repeat so train_steps can run across epoch boundaries; drop_remainder keeps batch shapes static
+train_ds = ds.to_dataset(BATCH_SIZE, drop_remainder=True).map(lambda x, _: x).repeat()
+
+train(train_ds, EPOCHS, len(ds) // BATCH_SIZE)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import tensorflow as tf
+import numpy as np
+import time
+import sys
+
+from genart.tf.upscale.model import UpScaleModel
+
+class ArrayBands:
+    """ row bands from an in-memory (H, W, 3) image in [-1, 1] """
+    def __init__(self, image):
+        self.image = image
+        self.shape = image.shape
+
+    def read_band(self, y, h):
+        return np.asarray(self.image[y:y+h], dtype=np.float32)
+
+class JpegBands:
+    """ row bands decoded straight from a JPEG, so the full image is never held in memory """
+    def __init__(self, path):
+        self.data = tf.io.read_file(path)
+        self.shape = tuple(int(v) for v in tf.image.extract_jpeg_shape(self.data).numpy())
+
+    def read_band(self, y, h):
+        band = tf.image.decode_and_crop_jpeg(self.data, [ y, 0, h, self.shape[1] ], channels=3)
+        return (band.numpy().astype(np.float32) / 127.5) - 1.0
+
+def tile_starts(size, tile, stride):
+    stride = max(stride, 1)
+    starts = list(range(0, max(size - tile, 0) + 1, stride))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+def blend_window(size, overlap):
+    """ weights ramping up over the overlap at each edge, so neighbouring tiles cross-fade """
+    ramp = np.ones(size, dtype=np.float32)
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        ramp[:overlap] = np.minimum(ramp[:overlap], edge)
+        ramp[-overlap:] = np.minimum(ramp[-overlap:], edge[::-1])
+    return ramp
+
+def to_uint8(image):
+    return np.clip((image * 0.5 + 0.5) * 255.0 + 0.5, 0, 255).astype(np.uint8)
+
+def upscale(generator, source, out, scale=4, tile=128, overlap=16, batch_size=16):
+    """
+    upscale an image tile by tile.  source provides .shape and .read_band(y, h) (see ArrayBands,
+    JpegBands); out is a (H*scale, W*scale, 3) uint8 array, e.g. an np.memmap.  Only one band of
+    tiles and its output rows are in memory at a time.  Returns tiles/sec.
+    """
+    h, w = source.shape[:2]
+    th, tw = min(tile, h), min(tile, w)
+
+    # small images: keep the stride positive
+    overlap = max(min(overlap, th - 1, tw - 1), 0)
+
+    ys = tile_starts(h, th, th - overlap)
+    xs = tile_starts(w, tw, tw - overlap)
+
+    window = np.outer(blend_window(th*scale, overlap*scale), blend_window(tw*scale, overlap*scale))
+
+    # accumulates the output rows of the current band of tiles
+    acc = np.zeros((th*scale, w*scale, 3), dtype=np.float32)
+    wsum = np.zeros((th*scale, w*scale, 1), dtype=np.float32)
+
+    predict = tf.function(lambda x: generator(x, training=False))
+
+    start = time.time()
+
+    for yi, y in enumerate(ys):
+        band = source.read_band(y, th)
+        tiles = np.stack([ band[:, x:x+tw] for x in xs ])
+
+        for bi in range(0, len(xs), batch_size):
+            pred = predict(tiles[bi:bi+batch_size]).numpy()
+
+            for x, p in zip(xs[bi:bi+batch_size], pred):
+                acc[:, x*scale:(x+tw)*scale] += p * window[...,None]
+                wsum[:, x*scale:(x+tw)*scale] += window[...,None]
+
+        # rows above the next band are final
+        done = (ys[yi+1] - y) * scale if yi + 1 < len(ys) else th*scale
+        out[y*scale:y*scale+done] = to_uint8(acc[:done] / wsum[:done])
+
+        acc = np.roll(acc, -done, axis=0)
+        wsum = np.roll(wsum, -done, axis=0)
+        acc[-done:] = 0
+        wsum[-done:] = 0
+
+    return len(ys) * len(xs) / (time.time() - start)
+
+def upscale_file(generator, in_path, out_path, scale=4, **kwargs):
+    """ upscale a JPEG into a uint8 .npy file, streaming input bands and output rows """
+    source = JpegBands(in_path)
+    h, w = source.shape[:2]
+
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8, shape=(h*scale, w*scale, 3))
+    tiles_per_sec = upscale(generator, source, out, scale=scale, **kwargs)
+    out.flush()
+
+    return tiles_per_sec
+
+def load_generator(checkpoint_dir, levels=2):
+    generator = UpScaleModel(levels)
+    checkpoint = tf.train.Checkpoint(generator=generator)
+    checkpoint.restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+    return generator
+
+def main():
+    checkpoint_dir, in_path, out_path = sys.argv[1:4]
+
+    generator = load_generator(checkpoint_dir)
+    tiles_per_sec = upscale_file(generator, in_path, out_path)
+    print(f'{tiles_per_sec:.1f} tiles/sec')
+
+if __name__ == "__main__": main()
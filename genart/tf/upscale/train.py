@@ -1,7 +1,9 @@
 import tensorflow as tf
 from genart.tf.upscale.model import UpScaleModel, Discriminator
+from genart.tf.upscale.infer import upscale, ArrayBands
 from genart.gen_photos import PairedImageLoader
 import time
+import numpy as np
 import matplotlib.pyplot as plt
 import os
 
@@ -57,7 +59,7 @@ def fit(train_ds, epochs, batch_size, test_ds):
 
         # Train        
         bi = 0
-        for im_small, im_large in train_ds.iter_patch_pair((128,128), batch_size):
+        for im_small, im_large in train_ds.to_dataset((128,128), batch_size):
             train_step(im_small, im_large)
             if bi % 100 == 0:
                 print(f'trained {bi*batch_size} images')
@@ -117,8 +119,9 @@ checkpoint.restore(manager.latest_checkpoint)
 
 fit(data, EPOCHS, BATCH_SIZE, data)
 
-sm, lg = data[:3]
-out = model(sm)
+sm, lg = data.load_image_pair(0)
+out = np.zeros((sm.shape[0]*4, sm.shape[1]*4, 3), dtype=np.uint8)
+upscale(generator, ArrayBands(sm.numpy()), out)
 print(sm.shape)
 print(out.shape)
 
@@ -0,0 +1,111 @@
+import torch
+import numpy as np
+import threading
+import random
+import queue
+import os
+import re
+
+def snapshot(obj):
+    """ copy of a (nested) state dict with every tensor cloned to the cpu """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return { k: snapshot(v) for k, v in obj.items() }
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+def rng_state():
+    state = { 'torch': torch.get_rng_state(),
+              'numpy': np.random.get_state(),
+              'random': random.getstate() }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class CheckpointManager:
+    """
+    saves training state every `interval` steps to path/step_XXXXXXXX.pt.  State is snapshotted
+    on the calling thread and written on a background thread, to a temporary file that is then
+    renamed into place, so a crash never leaves a partial checkpoint.  Only the newest `keep`
+    checkpoints are kept.
+    """
+    def __init__(self, path, interval=500, keep=3):
+        self.path = path
+        self.interval = interval
+        self.keep = keep
+
+        os.makedirs(path, exist_ok=True)
+
+        # one pending write at most; a slow disk holds up training instead of piling up copies
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def checkpoint_path(self, step):
+        return os.path.join(self.path, f'step_{step:08d}.pt')
+
+    def checkpoints(self):
+        """ [(step, path), ...] sorted by step """
+        found = []
+        for fname in os.listdir(self.path):
+            m = re.match(r'step_(\d+)\.pt$', fname)
+            if m:
+                found.append((int(m.group(1)), os.path.join(self.path, fname)))
+        return sorted(found)
+
+    def latest(self):
+        """ the newest checkpoint's state, or None """
+        found = self.checkpoints()
+        if not found:
+            return None
+        return torch.load(found[-1][1], map_location='cpu', weights_only=False)
+
+    def should_save(self, step):
+        return step > 0 and step % self.interval == 0
+
+    def save(self, step, **state):
+        """ snapshot state (state dicts, counters, ...) plus the RNG state and queue it for writing """
+        if self.error is not None:
+            raise self.error
+
+        state = snapshot(state)
+        state['step'] = step
+        state['rng'] = rng_state()
+
+        self.queue.put((step, state))
+
+    def write_loop(self):
+        while True:
+            step, state = self.queue.get()
+            try:
+                path = self.checkpoint_path(step)
+                tmp_path = path + '.tmp'
+
+                with open(tmp_path, 'wb') as f:
+                    torch.save(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+
+                for _, old_path in self.checkpoints()[:-self.keep]:
+                    os.remove(old_path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """ block until every queued checkpoint is on disk """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
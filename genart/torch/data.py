@@ -1,25 +1,291 @@
 import torch
+import os
+import collections
 import h5py
 import numpy as np
 
 class GenartDataSet(torch.utils.data.Dataset):
-    def __init__(self, h5_file, dtype=np.float32, key='data'):
+    """
+    images from an HDF5 file.  The file is opened lazily, once per process, so the dataset can be
+    handed to DataLoader workers (fork or spawn).  Indexing with a list of indices reads the whole
+    batch at once, as contiguous slices; see SortedBatchSampler and batch_loader.  With
+    dtype=None samples keep the file's dtype (e.g. uint8) and normalize_batch converts them
+    on the device.
+    """
+    def __init__(self, h5_file, dtype=np.float32, key='data', chunk_cache_bytes=None):
         super().__init__()
 
         self.h5_file = h5_file
-        self.h5f = h5py.File(h5_file, 'r')
-        self.ds = self.h5f[key]
+        self.key = key
         self.dtype=dtype
+        self.chunk_cache_bytes = chunk_cache_bytes
+
+        with h5py.File(h5_file, 'r') as f:
+            self.shape = f[key].shape
+            self.chunks = f[key].chunks
+            self.storage_dtype = f[key].dtype
+
+        self.h5f = None
+        self.pid = None
+
+    @property
+    def ds(self):
+        # handles must not be shared across processes
+        if self.h5f is None or self.pid != os.getpid():
+            self.h5f = h5py.File(self.h5_file, 'r', rdcc_nbytes=self.chunk_cache_bytes)
+            self.pid = os.getpid()
+        return self.h5f[self.key]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['h5f'] = None
+        state['pid'] = None
+        return state
 
     def __len__(self):
-        return self.ds.shape[0]
+        return self.shape[0]
+
+    @property
+    def chunk_length(self):
+        """ samples per HDF5 chunk along the first axis, None if the dataset is not chunked """
+        return self.chunks[0] if self.chunks else None
+
+    @property
+    def chunk_bytes(self):
+        return int(np.prod(self.chunks)) * self.storage_dtype.itemsize if self.chunks else 0
+
+    def read_indices(self, indices):
+        """ read a batch as one slice per run of consecutive indices, returned in the order given """
+        indices = np.asarray(indices)
+        order = np.argsort(indices, kind='stable')
+        sorted_idxs = indices[order]
+
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.ds.dtype)
+
+        breaks = np.flatnonzero(np.diff(sorted_idxs) != 1) + 1
+        for run_start, run_end in zip(np.r_[0, breaks], np.r_[breaks, len(sorted_idxs)]):
+            lo = sorted_idxs[run_start]
+            hi = sorted_idxs[run_end-1] + 1
+            self.ds.read_direct(out, np.s_[lo:hi], np.s_[run_start:run_end])
+
+        if np.any(np.diff(order) < 0):
+            out = out[np.argsort(order)]
+        return out
 
     def __getitem__(self, index):
-        #return self.ds[index], 0
-        return self.ds[index].astype(self.dtype), 0
+        if np.ndim(index) > 0:
+            imgs = self.read_indices(index)
+            if self.dtype is not None:
+                imgs = imgs.astype(self.dtype, copy=False)
+            return imgs, np.zeros(len(index), dtype=np.int64)
+
+        img = self.ds[index]
+        if self.dtype is not None:
+            img = img.astype(self.dtype)
+        return img, 0
 
     def __del__(self):
-        self.h5f.close()
-        
-            
-        
+        if self.h5f is not None and self.pid == os.getpid():
+            self.h5f.close()
+
+class ResumableBatchSampler(torch.utils.data.Sampler):
+    """
+    base for the batch samplers below.  Each pass draws its order from a fresh seed, so a pass
+    can be replayed from a checkpoint: state_dict(batches_done) records the seed and position,
+    and after load_state_dict the next pass repeats that order and skips the batches already
+    trained on.  The position comes from the training loop because DataLoader workers run ahead
+    of it.  Subclasses implement batches(rng).
+    """
+    def __init__(self, n, batch_size, drop_last=False):
+        self.n = n
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = None
+        self.resume_state = None
+
+    def __iter__(self):
+        if self.resume_state is not None:
+            self.seed, start = self.resume_state['seed'], self.resume_state['position']
+            self.resume_state = None
+        else:
+            self.seed, start = np.random.randint(2**31), 0
+
+        rng = np.random.RandomState(self.seed)
+        for bi, batch in enumerate(self.batches(rng)):
+            if bi >= start:
+                yield batch
+
+    def state_dict(self, batches_done):
+        return { 'seed': self.seed, 'position': batches_done }
+
+    def load_state_dict(self, state):
+        self.resume_state = state
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n // self.batch_size
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+class SortedBatchSampler(ResumableBatchSampler):
+    """
+    yields batches of indices, sorted so GenartDataSet reads them as contiguous runs.  With
+    run_length > 1, batches are built from shuffled runs of consecutive samples, which trades
+    some randomness for fewer, larger reads.
+    """
+    def __init__(self, n, batch_size, shuffle=True, run_length=1, drop_last=False):
+        super().__init__(n, batch_size, drop_last)
+        self.shuffle = shuffle
+        self.run_length = run_length
+
+    def batches(self, rng):
+        runs = np.arange(0, self.n, self.run_length)
+        if self.shuffle:
+            runs = rng.permutation(runs)
+
+        idxs = (runs[:,None] + np.arange(self.run_length)[None,:]).ravel()
+        idxs = idxs[idxs < self.n]
+
+        for bi in range(len(self)):
+            yield np.sort(idxs[bi*self.batch_size:(bi+1)*self.batch_size]).tolist()
+
+class ChunkShuffleSampler(ResumableBatchSampler):
+    """
+    yields sorted batches of indices for chunked HDF5 data.  Chunks are visited in shuffled order,
+    `window` whole chunks at a time: their samples are shuffled together and drawn into batches,
+    and the next window of chunks is only loaded once every sample of the current one has been
+    drawn.  Reads stay sequential (each chunk is read about once per epoch) while batches still
+    mix samples from window chunks.  Samples that don't fill a whole batch at the end of a window
+    come from a single chunk and finish in the next window's first batch.
+
+    DataLoader hands batches to its workers round-robin, and each worker has its own HDF5 chunk
+    cache, so with n_workers > 0 the shuffled chunks are split into one contiguous share per
+    worker and batch i is always drawn from the share of worker i % n_workers.  Give the dataset
+    a chunk cache of window + 1 chunks (see chunk_cache_size); count_chunk_loads checks the result.
+    Resuming mid-epoch may shift which worker gets which share, which costs reads, not samples.
+    """
+    def __init__(self, n, chunk_length, batch_size, window=8, n_workers=0, drop_last=False):
+        super().__init__(n, batch_size, drop_last)
+        self.chunk_length = chunk_length
+        self.window = window
+        self.n_streams = max(n_workers, 1)
+
+    @classmethod
+    def for_dataset(cls, ds, batch_size, window=8, chunk_length=None, **kwargs):
+        chunk_length = chunk_length or ds.chunk_length or batch_size
+        return cls(len(ds), chunk_length, batch_size, window=window, **kwargs)
+
+    def stream_batches(self, idxs, rng):
+        """ batches from one stream's share of samples, given chunk by chunk """
+        chunks = np.split(idxs, np.flatnonzero(np.diff(idxs // self.chunk_length)) + 1)
+
+        carry = []
+        for i in range(0, len(chunks), self.window):
+            window_idxs = np.concatenate(chunks[i:i+self.window])
+
+            # whatever doesn't fill a whole batch is carried into the next window's first batch.
+            # take it from the window's last chunk rather than from all of them, so only that
+            # one chunk has to stay cached alongside the next window.
+            n_carry = (len(carry) + len(window_idxs)) % self.batch_size
+            body = window_idxs[:len(window_idxs)-n_carry]
+            pool = carry + rng.permutation(body).tolist()
+            carry = window_idxs[len(window_idxs)-n_carry:].tolist()
+
+            for bi in range(0, len(pool), self.batch_size):
+                yield sorted(pool[bi:bi+self.batch_size])
+
+        if carry:
+            yield sorted(carry)
+
+    def batches(self, rng):
+        chunk_starts = rng.permutation(np.arange(0, self.n, self.chunk_length))
+        idxs = np.concatenate([ rng.permutation(np.arange(s, min(s + self.chunk_length, self.n))) for s in chunk_starts ])
+
+        n_batches = len(self)
+        idxs = idxs[:min(n_batches * self.batch_size, self.n)]
+
+        # batch bi goes to stream bi % n_streams, so each stream gets exactly the samples for its batches
+        stream_sizes = []
+        for si in range(self.n_streams):
+            stream_batches = range(si, n_batches, self.n_streams)
+            stream_sizes.append(sum(min(self.batch_size, len(idxs) - bi * self.batch_size) for bi in stream_batches))
+
+        offsets = np.cumsum([0] + stream_sizes)
+        streams = [ self.stream_batches(idxs[lo:hi], rng) for lo, hi in zip(offsets[:-1], offsets[1:]) ]
+
+        for bi in range(n_batches):
+            yield next(streams[bi % self.n_streams])
+
+def chunk_cache_size(ds, window):
+    """ HDF5 chunk cache bytes, per worker, needed to keep a ChunkShuffleSampler window resident """
+    return (window + 1) * ds.chunk_bytes
+
+def count_chunk_loads(batches, chunk_length, cache_chunks, n_workers=0):
+    """
+    simulate per-worker LRU chunk caches of cache_chunks chunks, with batches dispatched
+    round-robin as DataLoader does, and return how many times each chunk is read on average
+    (1.0 means every chunk is read exactly once)
+    """
+    caches = [ collections.OrderedDict() for _ in range(max(n_workers, 1)) ]
+    loads = collections.Counter()
+
+    for bi, batch in enumerate(batches):
+        cache = caches[bi % len(caches)]
+
+        for idx in batch:
+            chunk = idx // chunk_length
+            if chunk in cache:
+                cache.move_to_end(chunk)
+                continue
+
+            loads[chunk] += 1
+            cache[chunk] = True
+            if len(cache) > cache_chunks:
+                cache.popitem(last=False)
+
+    return sum(loads.values()) / max(len(loads), 1)
+
+def batch_loader(ds, batch_size, shuffle=True, num_workers=4, sampler=None, **kwargs):
+    """
+    DataLoader that hands whole batches of indices to the dataset, so each worker reads a
+    batch in one go instead of sample by sample.  The loader gets its own torch.Generator
+    (loader.generator) for worker seeds, so starting an epoch doesn't draw from the global torch
+    RNG and checkpoints can save and restore it separately.
+    """
+    if sampler is None:
+        sampler = SortedBatchSampler(len(ds), batch_size, shuffle=shuffle)
+
+    if kwargs.get('generator') is None:
+        kwargs['generator'] = torch.Generator().manual_seed(np.random.randint(2**31))
+
+    return torch.utils.data.DataLoader(ds, sampler=sampler, batch_size=None, num_workers=num_workers,
+                                       persistent_workers=num_workers > 0, **kwargs)
+
+class ShapeShardDataSet(torch.utils.data.Dataset):
+    """ images from a gen_images build directory, as CHW arrays in [0,1], or raw with dtype=None """
+    def __init__(self, path, img_size=None, dtype=np.float32):
+        super().__init__()
+
+        from genart.gen_images import ShapeShards
+
+        self.shards = ShapeShards(path, img_size)
+        self.dtype = dtype
+        self.scale = 1.0 / 255.0 if np.issubdtype(self.shards.dtype, np.integer) else 1.0
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __getitem__(self, index):
+        img = self.shards[index].transpose(2,0,1)
+        if self.dtype is None:
+            return np.ascontiguousarray(img), 0
+
+        img = img.astype(self.dtype)
+        img *= self.scale
+        return img, 0
+
+def normalize_batch(imgs, dtype=torch.float32):
+    """ the first op of a model step: integer images to [0,1] floats, float images just cast """
+    if imgs.dtype.is_floating_point:
+        return imgs.to(dtype)
+    return imgs.to(dtype).div_(torch.iinfo(imgs.dtype).max)
+
@@ -0,0 +1,71 @@
+import torch
+import time
+import argparse
+
+from model import GenartAutoencoder
+
+class Decoder(torch.nn.Module):
+    """ the decoder half of a GenartAutoencoder, latent [N, latent_size] -> images [N, 3, H, W] """
+    def __init__(self, autoencoder):
+        super().__init__()
+        self.autoencoder = autoencoder
+
+    def forward(self, z):
+        return self.autoencoder.forward_decode(z)
+
+def load_decoder(weights_path, img_shape, latent_size, pool_size=None):
+    model = GenartAutoencoder(img_shape, latent_size, pool_size=pool_size)
+    model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+    return Decoder(model).eval()
+
+def script_decoder(decoder, latent_size):
+    """ trace with a fixed latent size and freeze for inference; the batch size stays free """
+    with torch.inference_mode():
+        traced = torch.jit.trace(decoder, torch.rand(1, latent_size))
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+def compile_decoder(decoder):
+    return torch.compile(decoder, dynamic=False)
+
+def benchmark(decoders, latent_size, batch_sizes=(1, 4, 16, 64, 256), n_iter=20, n_warmup=3):
+    """ per-batch latency and images/sec of each named decoder at each batch size """
+    for batch_size in batch_sizes:
+        z = torch.rand(batch_size, latent_size)
+
+        for name, decoder in decoders.items():
+            with torch.inference_mode():
+                # warmup also triggers compilation for each new batch size
+                for _ in range(n_warmup):
+                    decoder(z)
+
+                start = time.time()
+                for _ in range(n_iter):
+                    decoder(z)
+                elapsed = (time.time() - start) / n_iter
+
+            print(f'batch {batch_size:4d} {name:10s} {elapsed * 1000.0:9.2f} ms {batch_size / elapsed:9.1f} images/sec')
+
+def main():
+    parser = argparse.ArgumentParser(description='export / benchmark the GenartAutoencoder decoder')
+    parser.add_argument('command', choices=['export', 'benchmark'])
+    parser.add_argument('weights')
+    parser.add_argument('--out', default='decoder.pt', help='TorchScript output path for export')
+    parser.add_argument('--latent-size', type=int, default=786)
+    parser.add_argument('--image-size', type=int, default=256)
+    parser.add_argument('--pool-size', type=int, default=None)
+    args = parser.parse_args()
+
+    img_shape = (args.image_size, args.image_size, 3)
+    decoder = load_decoder(args.weights, img_shape, args.latent_size, args.pool_size)
+
+    if args.command == 'export':
+        scripted = script_decoder(decoder, args.latent_size)
+        scripted.save(args.out)
+        print(f'saved {args.out}, load with torch.jit.load')
+    else:
+        benchmark({ 'eager': decoder,
+                    'script': script_decoder(decoder, args.latent_size),
+                    'compile': compile_decoder(decoder) },
+                  args.latent_size)
+
+if __name__ == "__main__": main()
@@ -2,6 +2,12 @@ from torch import nn
 import torch
 import numpy as np
 
+def conv_out_size(size, n_layers):
+    """ spatial size after n_layers 3x3, stride 2, padding 1 convolutions """
+    for _ in range(n_layers):
+        size = (size + 1) // 2
+    return size
+
 class GenartGenerator(nn.Module):
     def __init__(self, input_size, image_shape, rlslope=0.2):
         super().__init__()
@@ -49,7 +55,8 @@ class GenartGenerator(nn.Module):
 
 
 class GenartDiscriminator(nn.Module):
-    def __init__(self, image_shape, rlslope=0.2):
+    def __init__(self, image_shape, rlslope=0.2, global_pool=False):
+        """ with global_pool the head averages over space, so any input resolution works """
         super().__init__()
 
         
@@ -79,8 +86,15 @@ class GenartDiscriminator(nn.Module):
             nn.Dropout2d(0.25),            
         )
 
+        if global_pool:
+            self.conv_pool = nn.AdaptiveAvgPool2d(1)
+            conv_out_features = 128
+        else:
+            self.conv_pool = nn.Identity()
+            conv_out_features = 128 * conv_out_size(image_shape[0], 4) * conv_out_size(image_shape[1], 4)
+
         self.conv_adv_layer = nn.Sequential(
-            nn.Linear(32768, 1),
+            nn.Linear(conv_out_features, 1),
             nn.Sigmoid()
         )
 
@@ -89,15 +103,24 @@ class GenartDiscriminator(nn.Module):
         #img_flat = img.view(img.shape[0], -1)
         #return self.model(img_flat)
 
-        out = self.model_conv(img)
+        out = self.conv_pool(self.model_conv(img))
         out = out.view(out.shape[0], -1)
         val = self.conv_adv_layer(out)
         return val
 
 class GenartAutoencoder(nn.Module):
-    def __init__(self, image_shape, latent_size, rlslope=0.2):
+    def __init__(self, image_shape, latent_size, rlslope=0.2, pool_size=None):
+        """
+        by default the latent and decoder input layers are sized for image_shape.  With pool_size,
+        encoder features are pooled to a pool_size grid and the decoder starts from a pool_size grid,
+        doubled by learned upsampling blocks until it reaches a quarter of the output size, so the
+        same weights train and run at pool_size * 4 * 2**k up to image_shape (see progressive training).
+        """
         super().__init__()
 
+        self.image_shape = image_shape
+        self.pool_size = pool_size
+
         self.encoder = nn.Sequential(
             nn.Conv2d(3, 16, 3, 2, 1),
             nn.LeakyReLU(rlslope, inplace=True),
@@ -113,17 +136,36 @@ class GenartAutoencoder(nn.Module):
             #nn.Dropout2d(0.25),            
         )
 
+        if pool_size is None:
+            self.encoder_pool = nn.Identity()
+            encoded_size = (conv_out_size(image_shape[0], 3), conv_out_size(image_shape[1], 3))
+            self.conv_init_size = (image_shape[0] // 4, image_shape[1] // 4)
+        else:
+            self.encoder_pool = nn.AdaptiveAvgPool2d(pool_size)
+            encoded_size = (pool_size, pool_size)
+            self.conv_init_size = (pool_size, pool_size)
+
         self.latent_layer = nn.Sequential(
-            nn.Linear(65536, latent_size),
+            nn.Linear(64 * encoded_size[0] * encoded_size[1], latent_size),
             nn.Sigmoid()
         )
 
-        self.conv_init_size = image_shape[0] // 4
-
         self.decoder_input_layer = nn.Sequential(
-            nn.Linear(latent_size, 128 * self.conv_init_size ** 2)            
+            nn.Linear(latent_size, 128 * self.conv_init_size[0] * self.conv_init_size[1])            
         )
 
+        # pool_size grid -> image_shape / 4 grid, one block per doubling; smaller outputs use the first few
+        self.decoder_grow = nn.ModuleList()
+        if pool_size is not None:
+            grid_size = pool_size
+            while grid_size * 2 <= image_shape[0] // 4:
+                self.decoder_grow.append(nn.Sequential(
+                    nn.Upsample(scale_factor=2),
+                    nn.Conv2d(128, 128, 3, stride=1, padding=1),
+                    nn.LeakyReLU(rlslope, inplace=True)
+                ))
+                grid_size *= 2
+
         self.decoder = nn.Sequential(            
             nn.Upsample(scale_factor=2),
             nn.Conv2d(128, 64, 3, stride=1, padding=1),
@@ -140,17 +182,31 @@ class GenartAutoencoder(nn.Module):
         #img_flat = img.view(img.shape[0], -1)
         #return self.model(img_flat)
 
-        encoded = self.encoder(img)
-        encoded_flat = encoded.view(encoded.shape[0], -1)
+        encoded = self.encoder_pool(self.encoder(img))
+        encoded_flat = encoded.reshape(encoded.shape[0], -1)
         latent = self.latent_layer(encoded_flat)
-        decoder_input = self.decoder_input_layer(latent)
-        decoder_input_square = decoder_input.view(decoder_input.shape[0], 128, self.conv_init_size, self.conv_init_size)
-        decoded = self.decoder(decoder_input_square)
-        return decoded
+        return self.forward_decode(latent, img.shape[2:])
 
-    def forward_decode(self, z):
+    def forward_decode(self, z, size=None):
+        """ size is the (H, W) to decode to; only pooled models can decode to other than image_shape """
         decoder_input = self.decoder_input_layer(z)
-        decoder_input_square = decoder_input.view(decoder_input.shape[0], 128, self.conv_init_size, self.conv_init_size)
+        decoder_input_square = decoder_input.view(decoder_input.shape[0], 128, *self.conv_init_size)
+
+        if self.pool_size is not None:
+            if size is None:
+                size = self.image_shape[:2]
+            grid_size = (size[0] // 4, size[1] // 4)
+
+            for block in self.decoder_grow:
+                if decoder_input_square.shape[2] * 2 > grid_size[0]:
+                    break
+                decoder_input_square = block(decoder_input_square)
+
+            # only sizes off the doubling ladder need this, and then only a small smooth resize
+            if tuple(decoder_input_square.shape[2:]) != grid_size:
+                decoder_input_square = nn.functional.interpolate(decoder_input_square, size=grid_size,
+                                                                 mode='bilinear', align_corners=False)
+
         decoded = self.decoder(decoder_input_square)
         return decoded
     
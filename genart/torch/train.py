@@ -1,23 +1,125 @@
 import torch
 import os
+import time
+import argparse
 import numpy as np
 import skimage.io
 
-from data import GenartDataSet
+from data import GenartDataSet, ChunkShuffleSampler, batch_loader, chunk_cache_size, count_chunk_loads, normalize_batch
 from model import GenartAutoencoder
+from checkpoint import CheckpointManager, set_rng_state
 from torch.autograd import Variable
 
 from torchvision.utils import save_image
 
+PRECISIONS = { 'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16 }
+
+class StepRunner:
+    """
+    one optimizer step with optional autocast, channels-last inputs and gradient scaling.
+    Gradient scaling is only needed for fp16, so it defaults to on for fp16 and off otherwise.
+    """
+    def __init__(self, model, optimizer, loss, device, precision='fp32', channels_last=False, grad_scaling=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.loss = loss
+        self.device = device
+        self.amp_dtype = PRECISIONS[precision]
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+        if grad_scaling is None:
+            grad_scaling = precision == 'fp16'
+        self.scaler = torch.amp.GradScaler(device.type, enabled=grad_scaling)
+
+        self.model.to(device=device, memory_format=self.memory_format)
+
+    def __call__(self, imgs, size=None):
+        # batches arrive in the file's dtype (uint8 for image files): a quarter of the bytes to copy
+        imgs = normalize_batch(imgs.to(self.device, non_blocking=True))
+
+        if size is not None and tuple(imgs.shape[2:]) != tuple(size):
+            imgs = torch.nn.functional.interpolate(imgs, size=size, mode='area')
+
+        imgs = imgs.contiguous(memory_format=self.memory_format)
+
+        self.optimizer.zero_grad()
+
+        with torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            out_imgs = self.model(imgs)
+
+        # loss in float32 regardless of the autocast dtype
+        batch_loss = self.loss(out_imgs.float(), imgs)
+
+        self.scaler.scale(batch_loss).backward()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+
+        return out_imgs, batch_loss
+
+def progressive_schedule(n_epochs, final_size, n_stages=3):
+    """
+    [(first_epoch, size), ...]: start at final_size / 2**(n_stages-1) and double the resolution
+    at evenly spaced epochs, spending the second half of training at full resolution.
+    """
+    stage_epochs = [ 0 ] + [ (n_epochs // 2) * si // (n_stages - 1) for si in range(1, n_stages) ]
+    return [ (e, final_size // 2**(n_stages - 1 - si)) for si, e in enumerate(stage_epochs) ]
+
+def stage_size(schedule, epoch):
+    size = schedule[0][1]
+    for first_epoch, stage in schedule:
+        if epoch >= first_epoch:
+            size = stage
+    return size
+
+def benchmark(img_shape, latent_size, batch_size, device, lr, n_steps=20, n_warmup=3):
+    """ train on synthetic batches under each precision / memory format and report images/sec """
+    configs = [ ('fp32', False), ('fp32', True), ('bf16', False), ('bf16', True) ]
+    if device.type == 'cuda':
+        configs += [ ('fp16', False), ('fp16', True) ]
+
+    imgs = torch.rand(batch_size, img_shape[2], img_shape[0], img_shape[1])
+
+    for precision, channels_last in configs:
+        model = GenartAutoencoder(img_shape, latent_size)
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr, betas=(0.5,0.999))
+        step = StepRunner(model, optimizer, torch.nn.MSELoss(), device, precision, channels_last)
+
+        for _ in range(n_warmup):
+            step(imgs)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+
+        for _ in range(n_steps):
+            step(imgs)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+
+        layout = 'channels_last' if channels_last else 'nchw'
+        print(f'{precision:5s} {layout:14s} {n_steps * batch_size / elapsed:8.1f} images/sec')
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--precision', choices=list(PRECISIONS), default='fp32')
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--grad-scaling', action='store_true', default=None, help='default: on for fp16 only')
+    parser.add_argument('--progressive', action='store_true', help='grow the training resolution over time')
+    parser.add_argument('--benchmark', action='store_true', help='report images/sec per configuration and exit')
+    args = parser.parse_args()
+
     latent_size = 786
     n_epochs = 200
     img_shape = (256, 256, 3)
     image_save_interval = 400
     epoch_save_interval = 10
+    checkpoint_interval = 500 # steps
     lr = 0.0002
     batch_size = 10
+    num_workers = 4
+    shuffle_window = 8 # chunks
 
     save_path = "./out"
     train_data_path = './circles.h5'
@@ -26,41 +128,78 @@ def main():
     device = torch.device("cuda:0" if use_cuda else "cpu")
     #cudnn.benchmark = True
 
-    ds = GenartDataSet(train_data_path, dtype=np.float32)
+    if args.benchmark:
+        benchmark(img_shape, latent_size, batch_size, device, lr)
+        return
 
-    loader = torch.utils.data.DataLoader(ds, batch_size=batch_size, shuffle=True, num_workers=0)
+    ds = GenartDataSet(train_data_path, dtype=None)
+    ds.chunk_cache_bytes = chunk_cache_size(ds, shuffle_window)
 
-    model = GenartAutoencoder(img_shape, latent_size)
-    #model.half()
+    sampler = ChunkShuffleSampler.for_dataset(ds, batch_size, window=shuffle_window, n_workers=num_workers)
+    chunk_loads = count_chunk_loads(sampler.batches(np.random.RandomState(0)), sampler.chunk_length, shuffle_window + 1, num_workers)
+    print(f'sampler reads each chunk {chunk_loads:.2f}x per epoch')
+    loader = batch_loader(ds, batch_size, sampler=sampler, num_workers=num_workers, pin_memory=use_cuda)
 
-    if use_cuda:
-        model.to(device)
+    if args.progressive:
+        # resolution-independent heads, so weights carry over between stages.  The decoder starts
+        # at the first stage's grid and each later stage adds a learned upsampling block.
+        schedule = progressive_schedule(n_epochs, img_shape[0])
+        model = GenartAutoencoder(img_shape, latent_size, pool_size=schedule[0][1] // 4)
+        print(f'progressive stages {schedule}, load weights with pool_size={model.pool_size}')
+    else:
+        model = GenartAutoencoder(img_shape, latent_size)
+        schedule = [ (0, img_shape[0]) ]
 
     optimizer = torch.optim.Adam(model.parameters(), lr=lr, betas=(0.5,0.999))
     loss = torch.nn.MSELoss()
 
-    for ni, epoch in enumerate(range(n_epochs)):
-        for bi, (imgs,_) in enumerate(loader):              
-            if use_cuda:
-                imgs = imgs.cuda().to(device)
+    step = StepRunner(model, optimizer, loss, device, args.precision, args.channels_last, args.grad_scaling)
+
+    checkpoints = CheckpointManager(os.path.join(save_path, 'checkpoints'), interval=checkpoint_interval)
+    global_step, start_epoch, start_batch = 0, 0, 0
+
+    state = checkpoints.latest()
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        step.scaler.load_state_dict(state['scaler'])
+        sampler.load_state_dict(state['sampler'])
+        loader.generator.set_state(state['loader_rng'])
+        set_rng_state(state['rng'])
+
+        global_step, start_epoch, start_batch = state['step'], state['epoch'], state['sampler']['position']
+        print(f'resuming at epoch {start_epoch}, batch {start_batch} (step {global_step})')
 
-            optimizer.zero_grad()
+    for ni in range(start_epoch, n_epochs):
+        size = stage_size(schedule, ni)
+        if args.progressive:
+            print(f'Epoch {ni} - training at {size}x{size}')
 
-            # noise input
-            out_imgs = model(imgs)
-            batch_loss = loss(out_imgs, imgs)
-            batch_loss.backward()
-            optimizer.step()
+        for bi, (imgs,_) in enumerate(loader, start_batch):              
+            out_imgs, batch_loss = step(imgs, (size, size))
+            global_step += 1
+
+            if checkpoints.should_save(global_step):
+                checkpoints.save(global_step, epoch=ni,
+                                 model=model.state_dict(),
+                                 optimizer=optimizer.state_dict(),
+                                 scaler=step.scaler.state_dict(),
+                                 sampler=sampler.state_dict(bi+1),
+                                 loader_rng=loader.generator.get_state())
 
             if bi % image_save_interval == 0:
                 print(f'Epoch {ni}, Batch {bi} - saving images')
-                save_image(out_imgs.data[:9],
+                save_image(out_imgs.data[:9].float(),
                         os.path.join(save_path, f'images_{ni:04d}_{bi:04d}.png'),
                         nrow=3, range=[0,1])
         
         if ni % epoch_save_interval == 0:
             print(f'Epoch {ni} - saving weights')
             torch.save(model.state_dict(), os.path.join(save_path, f'model_{ni:04d}.weights'))
+
+        start_batch = 0
+
+    checkpoints.wait()
     print("done")
 
 if __name__ == "__main__": main()
@@ -1,83 +1,147 @@
 import torch
 import os
+import argparse
 import numpy as np
 import skimage.io
 
-from data import GenartDataSet
+from data import GenartDataSet, batch_loader, normalize_batch
 from model import GenartGenerator, GenartDiscriminator
+from checkpoint import CheckpointManager, set_rng_state
+from train import PRECISIONS
 from torch.autograd import Variable
 
 from torchvision.utils import save_image
 
 Tensor = torch.FloatTensor
 
-latent_size = 10
-n_epochs = 100
-img_shape = (256, 256, 3)
-save_interval = 5
-lr = 0.0002
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--precision', choices=list(PRECISIONS), default='fp32')
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--grad-scaling', action='store_true', default=None, help='default: on for fp16 only')
+    args = parser.parse_args()
 
-save_path = "./out"
+    latent_size = 10
+    n_epochs = 100
+    img_shape = (256, 256, 3)
+    save_interval = 5
+    checkpoint_interval = 500 # steps
+    lr = 0.0002
 
-ds = GenartDataSet('./circles.h5')
+    save_path = "./out"
 
-loader = torch.utils.data.DataLoader(ds, batch_size=10, shuffle=True, num_workers=0)
+    num_workers = 4
 
-generator = GenartGenerator(latent_size, img_shape)
+    # workers may re-import this module (spawn), so nothing runs at import time
+    ds = GenartDataSet('./circles.h5', dtype=None)
 
-discriminator = GenartDiscriminator(img_shape)
+    loader = batch_loader(ds, 10, shuffle=True, num_workers=num_workers)
 
-optimizer_g = torch.optim.Adam(generator.parameters(), lr=lr, betas=(0.5,0.999))
-optimizer_d = torch.optim.Adam(discriminator.parameters(), lr=lr, betas=(0.5,0.999))
-adversarial_loss = torch.nn.BCELoss()
+    generator = GenartGenerator(latent_size, img_shape)
 
-for ni, epoch in enumerate(range(n_epochs)):
-    for bi, (imgs,_) in enumerate(loader):
-        # ground truths
-        valid = Variable(Tensor(imgs.size(0),1).fill_(1.0), requires_grad=False)
-        fake = Variable(Tensor(imgs.size(0),1).fill_(0.0), requires_grad=False)
+    discriminator = GenartDiscriminator(img_shape)
 
-        real_imgs = Variable(imgs.type(Tensor))
+    # same precision / memory format handling as train.StepRunner; everything stays on the cpu
+    amp_dtype = PRECISIONS[args.precision]
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    grad_scaling = args.precision == 'fp16' if args.grad_scaling is None else args.grad_scaling
 
-        # train generator
-        # ---------------
-        optimizer_g.zero_grad()
+    generator.to(memory_format=memory_format)
+    discriminator.to(memory_format=memory_format)
 
-        # noise input
-        z = Variable(Tensor(np.random.normal(0, 1, (real_imgs.shape[0], latent_size))))
+    def autocast():
+        return torch.autocast('cpu', dtype=amp_dtype, enabled=amp_dtype is not None)
 
-        fake_imgs = generator(z)
+    optimizer_g = torch.optim.Adam(generator.parameters(), lr=lr, betas=(0.5,0.999))
+    optimizer_d = torch.optim.Adam(discriminator.parameters(), lr=lr, betas=(0.5,0.999))
+    scaler = torch.amp.GradScaler('cpu', enabled=grad_scaling)
+    adversarial_loss = torch.nn.BCELoss()
 
-        gen_loss = adversarial_loss(discriminator(fake_imgs), valid)
+    checkpoints = CheckpointManager(os.path.join(save_path, 'checkpoints'), interval=checkpoint_interval)
+    global_step, start_epoch, start_batch = 0, 0, 0
 
-        gen_loss.backward()
+    state = checkpoints.latest()
+    if state is not None:
+        generator.load_state_dict(state['generator'])
+        discriminator.load_state_dict(state['discriminator'])
+        optimizer_g.load_state_dict(state['optimizer_g'])
+        optimizer_d.load_state_dict(state['optimizer_d'])
+        scaler.load_state_dict(state['scaler'])
+        loader.sampler.load_state_dict(state['sampler'])
+        loader.generator.set_state(state['loader_rng'])
+        set_rng_state(state['rng'])
 
-        optimizer_g.step()
+        global_step, start_epoch, start_batch = state['step'], state['epoch'], state['sampler']['position']
+        print(f'resuming at epoch {start_epoch}, batch {start_batch} (step {global_step})')
 
-        # train discriminator
-        # -------------------
+    for ni in range(start_epoch, n_epochs):
+        for bi, (imgs,_) in enumerate(loader, start_batch):
+            # ground truths
+            valid = Variable(Tensor(imgs.size(0),1).fill_(1.0), requires_grad=False)
+            fake = Variable(Tensor(imgs.size(0),1).fill_(0.0), requires_grad=False)
 
-        real_vals = discriminator(real_imgs)
-        real_loss = adversarial_loss(real_vals, valid)
+            real_imgs = Variable(normalize_batch(imgs).type(Tensor)).contiguous(memory_format=memory_format)
 
-        fake_vals = discriminator(fake_imgs.detach())
-        fake_loss = adversarial_loss(fake_vals, fake)
+            # train generator
+            # ---------------
+            optimizer_g.zero_grad()
 
-        d_loss = (real_loss + fake_loss) * 0.5
+            # noise input
+            z = Variable(Tensor(np.random.normal(0, 1, (real_imgs.shape[0], latent_size))))
 
-        d_loss.backward()
+            with autocast():
+                fake_imgs = generator(z)
+                fake_gen_vals = discriminator(fake_imgs)
 
-        optimizer_d.step()
-        
-        if bi % save_interval == 0:
-            print(f'Epoch {ni}, Batch {bi} - saving')
-            save_image(fake_imgs.data[:9],
-                       os.path.join(save_path, f'images_{ni:04d}_{bi:04d}.png'),
-                       nrow=3, range=[0,1])
-            save_image(real_imgs.data[:9],
-                       os.path.join(save_path, f'real_images_{ni:04d}_{bi:04d}.png'),
-                       nrow=3, range=[0,1])
-                
-            
+            # BCE is not autocast-safe, so losses are computed in float32
+            gen_loss = adversarial_loss(fake_gen_vals.float(), valid)
 
-print("done")
+            scaler.scale(gen_loss).backward()
+
+            scaler.step(optimizer_g)
+
+            # train discriminator
+            # -------------------
+            # drops the gradients gen_loss sent through D, as well as last step's
+            optimizer_d.zero_grad()
+
+            with autocast():
+                real_vals = discriminator(real_imgs)
+                fake_vals = discriminator(fake_imgs.detach())
+
+            real_loss = adversarial_loss(real_vals.float(), valid)
+            fake_loss = adversarial_loss(fake_vals.float(), fake)
+
+            d_loss = (real_loss + fake_loss) * 0.5
+
+            scaler.scale(d_loss).backward()
+
+            scaler.step(optimizer_d)
+            scaler.update()
+            global_step += 1
+
+            if checkpoints.should_save(global_step):
+                checkpoints.save(global_step, epoch=ni,
+                                 generator=generator.state_dict(),
+                                 discriminator=discriminator.state_dict(),
+                                 optimizer_g=optimizer_g.state_dict(),
+                                 optimizer_d=optimizer_d.state_dict(),
+                                 scaler=scaler.state_dict(),
+                                 sampler=loader.sampler.state_dict(bi+1),
+                                 loader_rng=loader.generator.get_state())
+
+            if bi % save_interval == 0:
+                print(f'Epoch {ni}, Batch {bi} - saving')
+                save_image(fake_imgs.data[:9].float(),
+                           os.path.join(save_path, f'images_{ni:04d}_{bi:04d}.png'),
+                           nrow=3, range=[0,1])
+                save_image(real_imgs.data[:9],
+                           os.path.join(save_path, f'real_images_{ni:04d}_{bi:04d}.png'),
+                           nrow=3, range=[0,1])
+
+        start_batch = 0
+
+    checkpoints.wait()
+    print("done")
+
+if __name__ == "__main__": main()
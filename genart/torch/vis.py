@@ -1,81 +1,74 @@
 from model import GenartAutoencoder
-from data import GenartDataSet
+from data import GenartDataSet, normalize_batch
 import torch
 import numpy as np
 from torchvision.utils import save_image
+import multiprocessing as mp
 import random
 import skimage.io as skio
+import re
 import os
 
-def vis_random(model_idxs, N, img_shape, latent_size, out_path):
-    z = np.random.uniform(0, 1, (N, latent_size)).astype(np.float32)
-    z = torch.from_numpy(z) 
-
-    for model_idx in model_idxs:
-        try:
-            model = load_autoencoder(model_idx, img_shape, latent_size)            
-        except FileNotFoundError as e:            
-            continue
-        #z = np.random.normal(0, .5, (N, latent_size)).astype(np.float32)    
-
-        print(model_idx)
-
-        imgs = model.forward_decode(z)
-
-        save_image(imgs,
-                   out_path % model_idx,
+def find_checkpoints(weights_dir='out'):
+    """ [(model_idx, path), ...] for every model_XXXX.weights file, sorted by index """
+    checkpoints = []
+    for fname in os.listdir(weights_dir):
+        m = re.match(r'model_(\d+)\.weights$', fname)
+        if m:
+            checkpoints.append((int(m.group(1)), os.path.join(weights_dir, fname)))
+    return sorted(checkpoints)
+
+class CheckpointSweep:
+    """
+    renders the random, trained and untrained grids for one checkpoint at a time, swapping
+    weights into a single model instance
+    """
+    def __init__(self, img_shape, latent_size, z, trained_imgs, untrained_img, out_paths, pool_size=None):
+        self.model = GenartAutoencoder(img_shape, latent_size, pool_size=pool_size)
+        self.model.eval()
+
+        self.z = z
+        self.trained_imgs = trained_imgs
+        self.untrained_img = untrained_img
+        self.out_paths = out_paths
+
+    @torch.inference_mode()
+    def render(self, model_idx, weights_path):
+        self.model.load_state_dict(torch.load(weights_path, map_location='cpu'))
+
+        save_image(self.model.forward_decode(self.z),
+                   self.out_paths['random'] % model_idx,
                    nrow=3, range=[0,1])
 
-def vis_trained(model_idxs, img_idxs, img_shape, latent_size, train_data_path, out_path, out_gt_path):
-    ds = GenartDataSet(train_data_path)
-        
-    imgs,_ = ds[img_idxs]
-    imgs = torch.from_numpy(imgs.astype(np.float32))
-    
-    save_image(imgs,
-               out_gt_path,
-               nrow=3, range=[0,1])
-
-    for model_idx in model_idxs:
-        try:
-            model = load_autoencoder(model_idx, img_shape, latent_size)            
-        except FileNotFoundError:
-            continue
-
-        out_imgs = model.forward(imgs)
-
-        save_image(out_imgs,
-                   out_path % model_idx,
+        save_image(self.model(self.trained_imgs),
+                   self.out_paths['trained'] % model_idx,
                    nrow=3, range=[0,1])
 
+        save_image(self.model(self.untrained_img),
+                   self.out_paths['untrained'] % model_idx,
+                   range=[0,1])
 
-def vis_untrained(model_idxs, img, img_shape, latent_size, out_path):
-    img = torch.from_numpy(np.array([img]))
+        return model_idx
 
-    for model_idx in model_idxs:
-        try:
-            model = load_autoencoder(model_idx, img_shape, latent_size)            
-        except FileNotFoundError:
-            continue
-        print(img.shape)
-        out_imgs = model.forward(img)
+# one sweep per worker process, built by the pool initializer
+worker_sweep = None
 
-        save_image(out_imgs,
-                   out_path % model_idx,
-                   range=[0,1])
+def init_sweep_worker(n_threads, *args):
+    global worker_sweep
+    torch.set_num_threads(n_threads)
+    worker_sweep = CheckpointSweep(*args)
 
-        
+def render_checkpoint(checkpoint):
+    return worker_sweep.render(*checkpoint)
 
-def load_autoencoder(i, img_shape, latent_size):
-    weights_path = f'out/model_{i:04d}.weights'
-    
-    if not os.path.exists(weights_path):
-        raise FileNotFoundError("newp")
-    
-    model = GenartAutoencoder(img_shape, latent_size)
-    model.load_state_dict(torch.load(weights_path))    
+def sweep_checkpoints(checkpoints, img_shape, latent_size, z, trained_imgs, untrained_img, out_paths, n_workers=None, pool_size=None):
+    n_workers = n_workers or os.cpu_count()
+    n_threads = max(os.cpu_count() // n_workers, 1)
 
-    return model
+    init_args = (n_threads, img_shape, latent_size, z, trained_imgs, untrained_img, out_paths, pool_size)
+    with mp.Pool(n_workers, initializer=init_sweep_worker, initargs=init_args) as pool:
+        for model_idx in pool.imap_unordered(render_checkpoint, checkpoints):
+            print(model_idx)
 
 def main():
     latent_size = 512
@@ -84,12 +77,26 @@ def main():
     save_interval = 20
     lr = 0.0002
     batch_size = 40
+    pool_size = None # for weights from train.py --progressive, the pool_size it printed
 
     img = skio.imread('octopus5.png').transpose((2,0,1)).astype(np.float32) / 255.0
     img = img[:3,:,:]
-    vis_untrained(range(500), img, img_shape, latent_size, "vis/untrained_%04d.png")
-    vis_random(range(500), 9, img_shape, latent_size, "vis/random_%04d.png")
-    vis_trained(range(500), sorted(random.choices(range(10000),k=9)), img_shape, latent_size, "./circles.h5", "vis/trained_%04d.png", "vis/trained_inputs.png")
+    untrained_img = torch.from_numpy(np.array([img]))
+
+    z = torch.from_numpy(np.random.uniform(0, 1, (9, latent_size)).astype(np.float32))
+
+    # scaled the same way as in training
+    ds = GenartDataSet("./circles.h5", dtype=None)
+    trained_imgs,_ = ds[sorted(random.sample(range(len(ds)), k=9))]
+    trained_imgs = normalize_batch(torch.from_numpy(trained_imgs))
+    save_image(trained_imgs, "vis/trained_inputs.png", nrow=3, range=[0,1])
+
+    out_paths = { 'random': "vis/random_%04d.png",
+                  'trained': "vis/trained_%04d.png",
+                  'untrained': "vis/untrained_%04d.png" }
+
+    sweep_checkpoints(find_checkpoints('out'), img_shape, latent_size, z, trained_imgs, untrained_img, out_paths,
+                      pool_size=pool_size)
     
 
-if __name__ == "__main__": main()
\ No newline at end of file
+if __name__ == "__main__": main()